@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+""" Stand-in for the ORCA executable, used by the benchmarks
+
+    Called like ORCA with an input file, it sleeps for FAKE_ORCA_LATENCY seconds
+    (default 0.05) and prints a log with the lines the pipeline parses: SCF
+    convergence, E(SCF), Lowest Energy, the excited states, the absorption
+    spectrum, the normal termination and TOTAL RUN TIME. Energies are derived
+    from the geometry so a frame always gets the same numbers. Like ORCA it writes
+    '<name>.gbw', and a run reading its guess with MORead converges in fewer cycles.
+    FAKE_ORCA_PADDING lines of filler can be added to mimic the size of real logs.
+"""
+
+import os
+import re
+import sys
+import time
+import hashlib
+
+
+def frame_values(xyz_contents):
+    digest = hashlib.sha256(xyz_contents.encode('utf-8')).digest()
+    fraction = int.from_bytes(digest[:8], 'little') / 2 ** 64
+    return -230.0 - fraction, 0.18 + 0.05 * fraction
+
+
+def render_log(scf_energy, lowest_energy, cycles, run_seconds, num_states=5, padding=0):
+    lines = [
+        '                                 * O   R   C   A *',
+        '',
+        '                         *****************************************************',
+        '                         *                      SUCCESS                      *',
+        f'                         *           SCF CONVERGED AFTER {cycles:3d} CYCLES          *',
+        '                         *****************************************************',
+        '',
+        'TD-DFT/TDA EXCITED STATES',
+        f'E(SCF)  = {scf_energy:18.9f} Eh',
+        f'   Lowest Energy          : {lowest_energy:18.12f}',
+        '',
+    ]
+    for state in range(1, num_states + 1):
+        energy = lowest_energy + 0.01 * (state - 1)
+        lines.append(f'STATE {state:3d}:  E= {energy:10.6f} au {energy * 27.211386:10.3f} eV '
+                     f'{energy * 219474.63:10.1f} cm**-1 <S**2> =   0.000000')
+        lines.append(f'    20a ->  {20 + state}a  :     0.98')
+        lines.append('')
+    lines += [
+        '-----------------------------------------------------------------------------',
+        '         ABSORPTION SPECTRUM VIA TRANSITION ELECTRIC DIPOLE MOMENTS',
+        '-----------------------------------------------------------------------------',
+        'State   Energy    Wavelength  fosc         T2        TX        TY        TZ  ',
+        '        (cm-1)      (nm)                 (au**2)    (au)      (au)      (au) ',
+        '-----------------------------------------------------------------------------',
+    ]
+    for state in range(1, num_states + 1):
+        wavenumber = (lowest_energy + 0.01 * (state - 1)) * 219474.63
+        lines.append(f'{state:4d} {wavenumber:10.1f} {1e7 / wavenumber:8.1f}   {0.01 * state:.9f}'
+                     '   0.00000   0.00000   0.00000   0.00000')
+    lines.append('')
+    lines += [f'filler line {i} of a long ORCA property section' for i in range(padding)]
+    minutes, seconds = divmod(run_seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    lines += [
+        '',
+        '                             ****ORCA TERMINATED NORMALLY****',
+        f'TOTAL RUN TIME: 0 days {hours} hours {minutes} minutes {int(seconds)} seconds '
+        f'{int(seconds % 1 * 1000)} msec',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == "__main__":
+    input_path = sys.argv[1]
+    start = time.perf_counter()
+    with open(input_path) as input_file:
+        input_contents = input_file.read()
+
+    xyz_path = re.search(r'\*xyzfile\s+\S+\s+\S+\s+(\S+)', input_contents).group(1)
+    with open(xyz_path) as xyz_file:
+        scf_energy, lowest_energy = frame_values(xyz_file.read())
+
+    warm = 'moread' in input_contents.lower()
+    time.sleep(float(os.environ.get('FAKE_ORCA_LATENCY', '0.05')) * (0.6 if warm else 1.0))
+
+    with open(os.path.splitext(input_path)[0] + '.gbw', 'wb') as gbw_file:
+        gbw_file.write(os.urandom(4096))
+
+    sys.stdout.write(render_log(scf_energy, lowest_energy, 6 if warm else 14, time.perf_counter() - start,
+                                padding=int(os.environ.get('FAKE_ORCA_PADDING', '0'))))
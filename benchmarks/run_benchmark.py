@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+""" Offline benchmarks of the trajectory pipeline
+
+    Everything runs locally: synthetic trajectories, a fake ORCA executable
+    (fake_orca.py), bare git repositories and a DVC remote in a temporary
+    directory. Each stage runs in a process of its own and reports its frames per
+    second over the part being measured (not the setup), its peak RSS and its time
+    per pipeline stage.
+
+        python benchmarks/run_benchmark.py --frames 2000 --stages split parse store
+        python benchmarks/run_benchmark.py --frames 200 --latency 0.02 --stages end_to_end
+
+    The split, compute and end_to_end stages import script.py and therefore need
+    its dependencies (Celery, redis, sentry_sdk), end_to_end also a local
+    redis-server for the locks. publish and end_to_end need git and DVC, push_race git.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import subprocess
+import multiprocessing as mp
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIRECTORY))
+sys.path.insert(0, BENCHMARK_DIRECTORY)
+
+from synthetic import write_trajectory
+from fake_orca import render_log
+
+FAKE_ORCA = os.path.join(BENCHMARK_DIRECTORY, 'fake_orca.py')
+TEMPLATE = '! B3LYP def2-SVP TightSCF\n%pal nprocs 1 end\n%tddft nroots 5 end\n'
+STAGES = ('split', 'select', 'parse', 'store', 'compute', 'publish', 'push_race', 'end_to_end')
+
+
+def run(command, cwd):
+    subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# Function to point script.py at the benchmark directory instead of the cluster paths
+def configure_pipeline(work_directory, args):
+    import sentry_sdk
+    import script
+    from celery_app import app
+
+    # Nothing from a benchmark goes to Sentry
+    sentry_sdk.init()
+    app.conf.task_always_eager = True
+    app.conf.task_eager_propagates = True
+
+    template_directory = os.path.join(work_directory, 'template')
+    os.makedirs(template_directory, exist_ok=True)
+    for i in range(args.methods):
+        with open(os.path.join(template_directory, f'method{i}'), 'w') as template_file:
+            template_file.write(TEMPLATE)
+
+    script.orca_path = FAKE_ORCA
+    script.orca_core_budget = args.cores
+    script.template_path = template_directory
+    script.scratch_path = os.path.join(work_directory, 'scratch')
+    script.result_cache_path = os.path.join(work_directory, 'cache', 'orca_results.sqlite')
+    script.run_history_path = os.path.join(work_directory, 'cache', 'orca_run_history.sqlite')
+    script.metrics_textfile_directory = os.path.join(work_directory, 'metrics')
+    script.dvc_cache_path = os.path.join(work_directory, 'dvc-cache')
+    script.staging_path = os.path.join(work_directory, 'staging')
+    script.frame_selection_config = os.path.join(work_directory, 'frame_selection.json')
+    script.warm_start = args.warm_start
+    script.multi_method_tasks = not args.single_method_tasks
+    script.share_scf = not args.no_share_scf
+    os.environ['FAKE_ORCA_LATENCY'] = str(args.latency)
+    return script
+
+
+# Function to create a data repository with its bare origin and DVC remote
+def make_data_repository(work_directory, trajectory_path):
+    origin = os.path.join(work_directory, 'origin.git')
+    seed = os.path.join(work_directory, 'seed')
+    remote = os.path.join(work_directory, 'dvc-remote')
+    run(['git', 'init', '--bare', '-b', 'main', origin], work_directory)
+    run(['git', 'init', '-b', 'main', seed], work_directory)
+    run(['git', 'config', 'user.email', 'benchmark@localhost'], seed)
+    run(['git', 'config', 'user.name', 'benchmark'], seed)
+    run(['dvc', 'init'], seed)
+    run(['dvc', 'remote', 'add', '-d', 'local', remote], seed)
+    geometries = os.path.join(seed, 'benzene', 'cmd', 'geometries')
+    os.makedirs(geometries)
+    shutil.copy(trajectory_path, geometries)
+    run(['dvc', 'add', os.path.join(geometries, os.path.basename(trajectory_path))], seed)
+    run(['git', 'add', '-A'], seed)
+    run(['git', 'commit', '-m', 'add trajectory'], seed)
+    run(['dvc', 'push'], seed)
+    run(['git', 'remote', 'add', 'origin', origin], seed)
+    run(['git', 'push', 'origin', 'main'], seed)
+    return origin
+
+
+def clone(origin, destination):
+    run(['git', 'clone', origin, destination], os.path.dirname(destination))
+    run(['git', 'config', 'user.email', 'benchmark@localhost'], destination)
+    run(['git', 'config', 'user.name', 'benchmark'], destination)
+    return destination
+
+
+def stage_split(work_directory, trajectory_path, args):
+    from trajectory import XYZTrajectory
+    script = configure_pipeline(work_directory, args)
+    start = time.perf_counter()
+    with XYZTrajectory(trajectory_path):
+        pass
+    indexed = time.perf_counter()
+    written = script.separate_trajectory(trajectory_path, os.path.join(work_directory, 'split'), 'geometry')
+    return {'frames': len(written), 'seconds': time.perf_counter() - start,
+            'stages': {'frame_index': indexed - start,
+                       'separate_trajectory': time.perf_counter() - indexed}}
+
+
+def stage_select(work_directory, trajectory_path, args):
+    from frame_selection import select_frames
+    start = time.perf_counter()
+    frames, total_frames = select_frames(trajectory_path, {'count': max(args.frames // 10, 1), 'strategy': 'rmsd'})
+    seconds = time.perf_counter() - start
+    return {'frames': total_frames, 'seconds': seconds, 'stages': {'frame_selection': seconds}}
+
+
+def stage_parse(work_directory, trajectory_path, args):
+    from orca_parser import parse_orca_logs
+    log_directory = os.path.join(work_directory, 'logs')
+    os.makedirs(log_directory)
+    log_paths = []
+    for frame in range(args.frames):
+        log_paths.append(os.path.join(log_directory, f'geometry_{frame + 1}.log'))
+        with open(log_paths[-1], 'w') as log_file:
+            log_file.write(render_log(-230.0 - frame * 1e-6, 0.2, 14, 1.5, padding=args.log_padding))
+    start = time.perf_counter()
+    results = parse_orca_logs(log_paths)
+    assert all(result.complete for result in results)
+    seconds = time.perf_counter() - start
+    return {'frames': len(results), 'seconds': seconds, 'stages': {'log_parsing': seconds}}
+
+
+def stage_store(work_directory, trajectory_path, args):
+    from property_store import export_tsv, load_properties, write_properties
+    records = [{'frame': frame, 'es_energy': 5.0 + frame * 1e-6, 'gs_energy': -6260.0, 'run_time': 0.5}
+               for frame in range(args.frames)]
+    store = os.path.join(work_directory, 'store')
+    start = time.perf_counter()
+    write_properties(store, records)
+    written = time.perf_counter()
+    export_tsv(store, *(os.path.join(work_directory, 'tsv', f'{name}.dat') for name in ('es', 'gs', 'run_time')))
+    exported = time.perf_counter()
+    float(load_properties(store)['es_energy'].sum())
+    return {'frames': len(records), 'seconds': time.perf_counter() - start,
+            'stages': {'write_properties': written - start, 'export_tsv': exported - written,
+                       'load_properties': time.perf_counter() - exported}}
+
+
+def stage_compute(work_directory, trajectory_path, args):
+    script = configure_pipeline(work_directory, args)
+    import metrics
+    metrics.reset()
+    geometries = os.path.join(work_directory, 'geometries')
+    script.separate_trajectory(trajectory_path, geometries, 'geometry')
+    start = time.perf_counter()
+    with metrics.stage('calculate_energy'):
+        records = script.calculate_energies(geometries, os.path.join(work_directory, 'orca'), trajectory_path,
+                                            [f'method{i}' for i in range(args.methods)])
+    return {'frames': sum(len(method_records) for method_records in records.values()),
+            'seconds': time.perf_counter() - start, 'stages': metrics.current.to_dict()['timers']}
+
+
+def stage_publish(work_directory, trajectory_path, args):
+    from property_store import write_properties
+    from publish import publish_outputs
+    clone_directory = clone(make_data_repository(work_directory, trajectory_path), os.path.join(work_directory, 'work'))
+    properties = os.path.join(clone_directory, 'benzene', 'cmd', 'properties')
+    output_files = []
+    for i in range(args.methods):
+        store = os.path.join(properties, 'trajectory', 'arrays', f'method{i}')
+        write_properties(store, [{'frame': frame, 'es_energy': 5.0, 'gs_energy': -6260.0, 'run_time': 0.5}
+                                 for frame in range(args.frames)])
+        output_files.append(store)
+    start = time.perf_counter()
+    report = publish_outputs(clone_directory, output_files, 'main')
+    return {'frames': args.frames * args.methods, 'seconds': time.perf_counter() - start,
+            'stages': {name: report[name] for name in ('dvc_add', 'git_commit', 'git_push')}}
+
+
+def stage_push_race(work_directory, trajectory_path, args):
+    """ Push of the pipeline racing a human push to the same branch: the first push is
+        rejected, git_push has to pull (merge) and push again, and both commits must
+        end up on the remote """
+    from publish import git_push
+    origin = os.path.join(work_directory, 'origin.git')
+    run(['git', 'init', '--bare', '-b', 'main', origin], work_directory)
+    pipeline = clone(origin, os.path.join(work_directory, 'pipeline'))
+    human = clone(origin, os.path.join(work_directory, 'human'))
+    def commit(directory, name):
+        with open(os.path.join(directory, f'{name}.txt'), 'w') as commit_file:
+            commit_file.write(name)
+        run(['git', 'add', f'{name}.txt'], directory)
+        run(['git', 'commit', '-m', name], directory)
+
+    # Neither clone has a pull.rebase setting, as on a fresh worker
+    commit(pipeline, 'seed')
+    run(['git', 'push', 'origin', 'main'], pipeline)
+    run(['git', 'pull', 'origin', 'main'], human)
+    commit(human, 'human')
+    run(['git', 'push', 'origin', 'main'], human)
+    commit(pipeline, 'pipeline')
+    start = time.perf_counter()
+    attempts = git_push(pipeline, 'origin', 'main', base_delay=0.1)
+    seconds = time.perf_counter() - start
+    log = subprocess.check_output(['git', 'log', '--format=%s', 'main'], cwd=origin, universal_newlines=True).split()
+    if attempts != 2 or not {'human', 'pipeline'} <= set(log):
+        raise RuntimeError(f'push race not resolved: {attempts} attempts, remote history {log}')
+    return {'frames': 1, 'seconds': seconds, 'stages': {'git_push': seconds}}
+
+
+def stage_end_to_end(work_directory, trajectory_path, args):
+    script = configure_pipeline(work_directory, args)
+    import metrics
+    workrepo = os.path.join(work_directory, 'workrepo')
+    os.makedirs(workrepo)
+    clone(make_data_repository(work_directory, trajectory_path), os.path.join(workrepo, 'benchmark'))
+    script.workrepo_path = workrepo
+
+    fetch_metrics = metrics.reset()
+    start = time.perf_counter()
+    script.handle_webhook_event('benchmark', 'main', [os.path.basename(trajectory_path) + '.dvc'])
+    seconds = time.perf_counter() - start
+    event_metrics = metrics.Metrics()
+    event_metrics.merge(fetch_metrics.to_dict())
+    event_metrics.merge(metrics.totals.to_dict())
+    timers = event_metrics.to_dict()['timers']
+    return {'frames': args.frames * args.methods, 'seconds': seconds,
+            'stages': {name: timer['seconds'] for name, timer in timers.items()}}
+
+
+# Function to run one stage in a process of its own, so its peak RSS is its own
+def run_stage(name, args, queue):
+    work_directory = tempfile.mkdtemp(prefix=f'bench_{name}_', dir=args.work_directory)
+    try:
+        trajectory_path = write_trajectory(os.path.join(work_directory, 'trajectory.xyz'), args.frames, args.atoms)
+        result = globals()[f'stage_{name}'](work_directory, trajectory_path, args)
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        result['children_peak_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        queue.put(result)
+    except Exception as e:
+        queue.put({'error': f'{type(e).__name__}: {e}'})
+        raise
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+
+def format_stages(stages):
+    return ', '.join(f'{name} {seconds["seconds"] if isinstance(seconds, dict) else seconds:.3f}s'
+                     for name, seconds in sorted(stages.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the trajectory pipeline offline')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=['split', 'select', 'parse', 'store'])
+    parser.add_argument('--frames', type=int, default=1000, help='frames of the synthetic trajectory')
+    parser.add_argument('--atoms', type=int, default=12, help='atoms per frame')
+    parser.add_argument('--methods', type=int, default=2, help='number of ORCA templates')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the fake ORCA takes per frame')
+    parser.add_argument('--cores', type=int, default=os.cpu_count(), help='ORCA core budget')
+    parser.add_argument('--log-padding', type=int, default=2000, help='filler lines in the parsed logs')
+    parser.add_argument('--warm-start', action='store_true', help='chain frames with MORead in compute stages')
+    parser.add_argument('--no-share-scf', action='store_true', help='start every method from its own SCF')
+    parser.add_argument('--single-method-tasks', action='store_true', help='one compute subtask per trajectory and method')
+    parser.add_argument('--work-directory', default=None, help='where the temporary files go')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary files')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    context = mp.get_context('fork')
+    results = {}
+    for name in args.stages:
+        queue = context.Queue()
+        process = context.Process(target=run_stage, args=(name, args, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        results[name] = result
+        if 'error' in result:
+            print(f'{name:12s} failed: {result["error"]}')
+            continue
+        print(f'{name:12s} {result["frames"] / result["seconds"]:10.1f} frames/s  {result["seconds"]:8.3f} s  '
+              f'peak RSS {result["peak_rss_mb"]:8.1f} MB  [{format_stages(result["stages"])}]')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results}, f, indent=2)
+    sys.exit(1 if any('error' in result for result in results.values()) else 0)
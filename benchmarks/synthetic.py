@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+""" Synthetic multi-frame .xyz trajectories for the benchmarks """
+
+import math
+import random
+import argparse
+
+
+# Function to write a synthetic trajectory
+def write_trajectory(path, num_frames, num_atoms=12, amplitude=0.05, seed=0):
+    """ Function to write a trajectory of a ring molecule vibrating around its
+        equilibrium geometry, with the step and an energy in every comment line
+
+        Parameters:
+
+        path(str): path of the .xyz file to write
+        num_frames(int): number of frames
+        num_atoms(int): number of atoms of the molecule
+        amplitude(float): size of the random displacements, in Angstrom
+        seed(int): seed of the displacements, the same seed writes the same file
+
+        Return:
+
+        str: path of the written file
+    """
+    rng = random.Random(seed)
+    elements = ['C' if i % 2 == 0 else 'H' for i in range(num_atoms)]
+    equilibrium = []
+    for i in range(num_atoms):
+        angle = 2 * math.pi * i / num_atoms
+        radius = 1.39 if elements[i] == 'C' else 2.48
+        equilibrium.append((radius * math.cos(angle), radius * math.sin(angle), 0.0))
+
+    with open(path, 'w') as f:
+        for frame in range(num_frames):
+            displaced = [tuple(value + rng.gauss(0, amplitude) for value in position) for position in equilibrium]
+            energy = -230.0 + sum(dx * dx + dy * dy + dz * dz for dx, dy, dz in
+                                  ((a[0] - b[0], a[1] - b[1], a[2] - b[2]) for a, b in zip(displaced, equilibrium)))
+            f.write(f'{num_atoms}\n i = {frame}, time = {frame * 0.5:.3f}, E = {energy:.10f}\n')
+            for element, (x, y, z) in zip(elements, displaced):
+                f.write(f'  {element:2s} {x:14.8f} {y:14.8f} {z:14.8f}\n')
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write a synthetic multi-frame .xyz trajectory')
+    parser.add_argument('path')
+    parser.add_argument('--frames', type=int, default=1000)
+    parser.add_argument('--atoms', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_trajectory(args.path, args.frames, args.atoms, seed=args.seed)
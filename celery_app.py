@@ -1,5 +1,7 @@
 from __future__ import absolute_import, unicode_literals
+import time
 from celery import Celery
+from celery.signals import before_task_publish, celeryd_init
 from kombu import Queue
 
 app = Celery('script_task',
@@ -7,13 +9,69 @@ app = Celery('script_task',
              backend='redis://localhost:6379/0',
              include=['script'])
 
+# One queue per stage of an event, so I/O-bound and CPU-bound stages get worker pools of their own:
+#   fetch   git fetch and dvc pull of the pushed trajectories (network)
+#   split   frame index and frame selection of every trajectory (a few cores, short)
+#   compute ORCA runs and the parsing of their logs (every core of a node, hours)
+#   parse   merge of the per-frame results into the property stores (short)
+#   publish dvc add, commit and push of the outputs (network)
+# Start one worker per queue on the nodes that should run it, e.g. 'celery -A celery_app worker -Q compute -c 1'.
+# A worker consuming several queues gets the smallest prefetch multiplier among them.
+queue_worker_settings = {
+    'fetch': {'prefetch_multiplier': 1},
+    'split': {'prefetch_multiplier': 4},
+    'compute': {'prefetch_multiplier': 1},
+    'parse': {'prefetch_multiplier': 4},
+    'publish': {'prefetch_multiplier': 1},
+}
+
+# Longest time a task may stay unacknowledged before Redis hands it to another worker. The compute
+# tasks are acknowledged once done (acks_late), so it has to exceed the longest compute task: keep
+# frames_per_task (or runs_per_core_per_task) of script.py small enough for that.
+visibility_timeout = 48 * 3600
+
 app.conf.update(
     task_routes={
-        'script.run_script': {'queue': 'script'},
+        'script.run_script': {'queue': 'fetch'},
+        'script.split_trajectory_task': {'queue': 'split'},
+        'script.dispatch_event': {'queue': 'split'},
+        'script.process_file_task': {'queue': 'compute'},
+        'script.process_trajectory_task': {'queue': 'compute'},
+        'script.aggregate_event': {'queue': 'parse'},
+        'script.publish_event': {'queue': 'publish'},
+    },
+    task_queues=tuple(Queue(name, routing_key=f'{name}.#') for name in queue_worker_settings),
+    task_default_queue='compute',
+    task_default_routing_key='compute.default',
+    # A compute task lost with its worker (node crash, OOM kill) goes back to the queue instead of vanishing
+    task_annotations={
+        'script.process_file_task': {'acks_late': True, 'reject_on_worker_lost': True},
+        'script.process_trajectory_task': {'acks_late': True, 'reject_on_worker_lost': True},
     },
-    task_queues=(
-        Queue('script', routing_key='script.#'),
-    ),
-    task_default_queue='script',
-    task_default_routing_key='script.default'
-)
\ No newline at end of file
+    broker_transport_options={
+        'visibility_timeout': visibility_timeout,
+        # Priorities 0 (first) to 9 (last) within every queue, tasks without one get 0. The queues of a
+        # worker are read round robin (the default), so a backlog in one never starves the others.
+        'priority_steps': list(range(10)),
+        'sep': ':',
+    },
+    result_backend_transport_options={'visibility_timeout': visibility_timeout},
+    # The subtasks of an event keep the priority given to its run_script task
+    task_inherit_parent_priority=True,
+)
+
+@celeryd_init.connect
+# Function applying the settings of the queues a worker consumes, given with -Q
+def configure_queue_worker(conf=None, options=None, **kwargs):
+    queues = (options or {}).get('queues') or []
+    if isinstance(queues, str):
+        queues = queues.split(',')
+    settings = [queue_worker_settings[queue.strip()] for queue in queues if queue.strip() in queue_worker_settings]
+    if settings:
+        conf.worker_prefetch_multiplier = min(setting['prefetch_multiplier'] for setting in settings)
+
+@before_task_publish.connect
+# Function stamping every task with the time it was sent, to measure how long it waits in its queue
+def stamp_publish_time(headers=None, **kwargs):
+    if headers is not None:
+        headers['published_at'] = time.time()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import subprocess
+
+
+# Entry of a .dvc file naming a tracked file, e.g. '- path: traj.xyz' or '  path: "traj 2.xyz"'
+dvc_path_pattern = re.compile(r'^\s*(?:-\s+)?path:\s*(.+?)\s*$')
+
+
+# Function to read the outputs a .dvc file tracks
+def dvc_outputs(dvc_file):
+    """ Function to read the paths of the outputs listed under 'outs' in a .dvc file
+
+        Parameters:
+
+        dvc_file(str): path of the .dvc file
+
+        Return:
+
+        list: absolute paths of the outputs, resolved against the directory of the .dvc file
+    """
+    outputs = []
+    section = None
+    with open(dvc_file) as f:
+        for line in f:
+            if line.strip() == '' or line.lstrip().startswith('#'):
+                continue
+            if not line[0].isspace() and not line.startswith('-'):
+                section = line.split(':', 1)[0].strip()
+                continue
+            match = dvc_path_pattern.match(line)
+            if section == 'outs' and match:
+                outputs.append(os.path.normpath(os.path.join(os.path.dirname(dvc_file), match.group(1).strip('\'"'))))
+    return outputs
+
+
+# Function to point a clone at the DVC cache shared by every event of its repository
+def configure_shared_cache(directory, cache_directory):
+    """ Function to set the DVC cache of a clone, once: the objects pulled by an
+        event stay in cache_directory for the next events of the repository
+
+        Parameters:
+
+        directory(str): path of the git working tree
+        cache_directory(str): directory of the shared DVC cache
+    """
+    config_file = os.path.join(directory, '.dvc', 'config.local')
+    if os.path.exists(config_file):
+        with open(config_file) as f:
+            if re.search(rf'^\s*dir\s*=\s*{re.escape(cache_directory)}\s*$', f.read(), re.MULTILINE):
+                return
+    os.makedirs(cache_directory, exist_ok=True)
+    subprocess.run(['dvc', 'cache', 'dir', '--local', cache_directory], cwd=directory, check=True)
+
+
+# Function to bring the clone to the commit of a push
+def checkout_commit(directory, branch_name, commit_sha=None, remote='origin'):
+    """ Function to fetch the pushed commit alone and check the branch out at it
+
+        The clone is kept between events, so only the objects of the new commits
+        are transferred. Without a commit (an event sent without one), the tip of
+        the remote branch is used.
+
+        Parameters:
+
+        directory(str): path of the git working tree
+        branch_name(str): branch that was pushed
+        commit_sha(str): commit of the push, the 'after' field of the webhook payload
+        remote(str): name of the remote
+
+        Return:
+
+        str: the checked out commit
+    """
+    fetched = False
+    if commit_sha:
+        # Servers that refuse to serve a commit by its sha get the branch fetched instead
+        fetched = subprocess.run(['git', 'fetch', '--no-tags', remote, commit_sha], cwd=directory).returncode == 0
+    if not fetched:
+        subprocess.run(['git', 'fetch', '--no-tags', remote, branch_name], cwd=directory, check=True)
+    target = commit_sha or subprocess.check_output(['git', 'rev-parse', 'FETCH_HEAD'], cwd=directory,
+                                                   universal_newlines=True).strip()
+    subprocess.run(['git', 'checkout', '--force', '-B', branch_name, target], cwd=directory, check=True)
+    return target
+
+
+# Function to download the data of some .dvc files
+def pull_dvc_targets(directory, dvc_files, jobs=None):
+    """ Function to pull the outputs of the given .dvc files only, with parallel jobs
+
+        Parameters:
+
+        directory(str): path of the git working tree
+        dvc_files(list): paths of the .dvc files to pull
+        jobs(int): number of parallel downloads, DVC's default when None
+
+        Return:
+
+        list: paths of the outputs of the .dvc files
+    """
+    missing = [dvc_file for dvc_file in dvc_files if not os.path.exists(dvc_file)]
+    if missing:
+        raise FileNotFoundError(f'Not in the checked out commit: {missing}')
+    if not dvc_files:
+        return []
+    subprocess.run(['dvc', 'pull'] + (['--jobs', str(jobs)] if jobs else []) + list(dvc_files), cwd=directory, check=True)
+    return [output for dvc_file in dvc_files for output in dvc_outputs(dvc_file)]
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import re
+import json
+import numpy as np
+
+from trajectory import XYZTrajectory, count_frames, find_trajectory_files
+
+
+# Energy written by most MD codes in the comment line of a frame, e.g. 'i = 12, time = 6.0, E = -17.93'
+comment_energy_pattern = re.compile(r'\b(?:E|energy)\s*[=:]\s*(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)', re.IGNORECASE)
+
+
+# Function to read the energies of the comment lines of a trajectory
+def load_comment_energies(file_path):
+    """ Function to read the energy of the comment line of every frame of a
+        trajectory (or of every trajectory of a directory, one after the other),
+        through the frame index and without reading the atoms
+
+        Parameters:
+
+        file_path(str): path of a trajectory file or of a directory of trajectories
+
+        Return:
+
+        np.ndarray: float64 energy of every frame, NaN where absent
+    """
+    energies = []
+    for trajectory_file in find_trajectory_files(file_path):
+        with XYZTrajectory(trajectory_file) as trajectory:
+            for n in range(len(trajectory)):
+                match = comment_energy_pattern.search(trajectory.comment(n))
+                energies.append(float(match.group(1)) if match else np.nan)
+    return np.asarray(energies, dtype=np.float64)
+
+
+# Function to read the coordinates of some frames of a trajectory
+def load_coordinates(file_path, frames):
+    """ Function to read the coordinates of the given frames of a trajectory (or of
+        every trajectory of a directory, numbered one after the other) into an array
+        filled one frame at a time
+
+        Parameters:
+
+        file_path(str): path of a trajectory file or of a directory of trajectories
+        frames(np.ndarray): sorted frames to read (0-based)
+
+        Return:
+
+        np.ndarray: coordinates as a (frames, atoms, 3) float32 array
+    """
+    frames = np.asarray(frames, dtype=np.int64)
+    coordinates = None
+    first_frame = 0
+    for trajectory_file in find_trajectory_files(file_path):
+        with XYZTrajectory(trajectory_file) as trajectory:
+            start, stop = np.searchsorted(frames, [first_frame, first_frame + len(trajectory)])
+            for i in range(start, stop):
+                lines = trajectory.frame(int(frames[i]) - first_frame).split('\n')
+                num_atoms = int(lines[0])
+                if coordinates is None:
+                    coordinates = np.empty((len(frames), num_atoms, 3), dtype=np.float32)
+                elif num_atoms != coordinates.shape[1]:
+                    raise ValueError(f'{trajectory_file}: frames with different atom counts cannot be compared')
+                coordinates[i] = np.loadtxt(lines[2:2 + num_atoms], usecols=(1, 2, 3), dtype=np.float32, ndmin=2)
+            first_frame += len(trajectory)
+    if coordinates is None:
+        return np.empty((0, 0, 3), dtype=np.float32)
+    return coordinates
+
+
+# Function to compute the RMSD of many frames to one reference after Kabsch alignment
+def kabsch_rmsd(coordinates, reference, batch_size=4096):
+    """ Function to compute the RMSD of every frame to a reference after the optimal
+        rotation (Kabsch), vectorized over batches of frames
+
+        Parameters:
+
+        coordinates(np.ndarray): (frames, atoms, 3) array
+        reference(np.ndarray): (atoms, 3) array
+        batch_size(int): number of frames aligned at once, bounds the memory used
+
+        Return:
+
+        np.ndarray: RMSD of every frame, in the unit of the coordinates
+    """
+    reference = reference - reference.mean(axis=0)
+    reference_norm = np.sum(reference * reference)
+    num_atoms = reference.shape[0]
+    rmsd = np.empty(len(coordinates))
+
+    for start in range(0, len(coordinates), batch_size):
+        batch = coordinates[start:start + batch_size]
+        batch = batch - batch.mean(axis=1, keepdims=True)
+        covariance = np.einsum('fai,aj->fij', batch, reference)
+        u, singular_values, vt = np.linalg.svd(covariance)
+        # Flip the smallest singular value when the optimal transform is a reflection
+        reflection = np.sign(np.linalg.det(u) * np.linalg.det(vt))
+        singular_values[:, -1] *= reflection
+        squared = np.sum(batch * batch, axis=(1, 2)) + reference_norm - 2 * singular_values.sum(axis=1)
+        rmsd[start:start + batch_size] = np.sqrt(np.maximum(squared, 0) / num_atoms)
+    return rmsd
+
+
+# Function to pick the frames that are the most different from each other
+def farthest_point_selection(coordinates, count, first=0, batch_size=4096):
+    """ Function to pick count frames by farthest point sampling: every new frame is
+        the one with the largest RMSD to the frames already picked
+
+        Return:
+
+        np.ndarray: indices of the picked frames, sorted
+    """
+    count = min(count, len(coordinates))
+    if count <= 0:
+        return np.empty(0, dtype=np.int64)
+    selected = [first]
+    distance = kabsch_rmsd(coordinates, coordinates[first], batch_size)
+    for _ in range(count - 1):
+        candidate = int(np.argmax(distance))
+        if distance[candidate] <= 0:
+            break
+        selected.append(candidate)
+        np.minimum(distance, kabsch_rmsd(coordinates, coordinates[candidate], batch_size), out=distance)
+    return np.sort(np.asarray(selected, dtype=np.int64))
+
+
+# Function to select the frames of a trajectory to compute
+def select_frames(file_path, selection):
+    """ Function to select the frames of a trajectory before they are sent to ORCA
+
+        The steps of the selection are applied in this order, each one optional:
+
+        energy_window: [low, high], keep the frames whose comment line energy is within it
+        stride: keep one frame out of stride
+        count: keep count frames, evenly spaced with the 'uniform' strategy or the most
+               diverse ones by Kabsch RMSD with the 'rmsd' strategy
+
+        Parameters:
+
+        file_path(str): path of the trajectory
+        selection(dict): steps of the selection, e.g. {'stride': 5, 'count': 500, 'strategy': 'rmsd'}
+
+        Return:
+
+        tuple: sorted indices of the selected frames and the total number of frames
+    """
+    # Only the frame index and the comment lines are read, the coordinates only for the 'rmsd' strategy
+    total_frames = count_frames(file_path)
+    frames = np.arange(total_frames)
+
+    if selection.get('energy_window'):
+        low, high = selection['energy_window']
+        energies = load_comment_energies(file_path)
+        frames = frames[(energies >= low) & (energies <= high)]
+
+    frames = frames[::max(int(selection.get('stride', 1)), 1)]
+
+    count = selection.get('count')
+    if count and count < len(frames):
+        if selection.get('strategy', 'uniform') == 'rmsd':
+            coordinates = load_coordinates(file_path, frames)
+            frames = frames[farthest_point_selection(coordinates, count, batch_size=selection.get('batch_size', 4096))]
+        else:
+            frames = frames[np.unique(np.linspace(0, len(frames) - 1, count).round().astype(np.int64))]
+
+    return frames.tolist(), total_frames
+
+
+# Function to read the selection configured for a repository
+def load_selection_config(config_path, repo_name):
+    """ Function to read the selection of a repository from a JSON file mapping
+        repository names to selections, with '*' as the default for the others
+
+        Return:
+
+        dict: the selection, None when the frames are not subsampled
+    """
+    try:
+        with open(config_path) as config_file:
+            config = json.load(config_file)
+    except FileNotFoundError:
+        return None
+    return config.get(repo_name, config.get('*'))
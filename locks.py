@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import time
+import uuid
+import threading
+
+
+# Deletes the lock only if it still holds our token, so a lock that expired and was
+# taken by another worker is never released by mistake
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Pushes the expiry of the lock back only if it still holds our token
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class LockContended(Exception):
+    """ Raised when a lock could not be acquired within the allowed time """
+
+
+class LockLost(Exception):
+    """ Raised when a held lock expired and may have been taken by another worker """
+
+
+# Function to name the lock of the clone of a repository, shared by all its branches
+def repository_lock_name(repo_name):
+    return f'lock:repository:{repo_name}'
+
+
+class DistributedLock:
+    """ Redis lock owned through a random token and kept alive by a heartbeat
+
+        The lock expires after ttl seconds unless it is renewed. While it is held a
+        background thread renews it every ttl/3 seconds, so a long task keeps its
+        lock while a crashed worker loses it after at most ttl seconds instead of
+        wedging the queue.
+
+        Parameters:
+
+        client(redis.Redis): Redis connection
+        name(str): key of the lock
+        ttl(float): seconds before the lock expires without a heartbeat
+    """
+
+    def __init__(self, client, name, ttl=300):
+        self.client = client
+        self.name = name
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+        self.lost = False
+        self._release_script = client.register_script(RELEASE_SCRIPT)
+        self._renew_script = client.register_script(RENEW_SCRIPT)
+        self._stop_heartbeat = threading.Event()
+        self._heartbeat = None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockContended(f'Could not acquire {self.name}')
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def acquire(self, blocking=True, timeout=None, poll_interval=1.0):
+        """ Try to take the lock
+
+            Parameters:
+
+            blocking(bool): wait for the lock to be free instead of giving up at once
+            timeout(float): longest wait in seconds when blocking, None waits forever
+            poll_interval(float): seconds between two attempts
+
+            Return:
+
+            bool: True when the lock is held
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.client.set(self.name, self.token, nx=True, px=int(self.ttl * 1000)):
+            if not blocking or (deadline is not None and time.monotonic() >= deadline):
+                return False
+            time.sleep(poll_interval)
+
+        self.lost = False
+        self._stop_heartbeat.clear()
+        self._heartbeat = threading.Thread(target=self._renew_until_released, name=f'heartbeat {self.name}', daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def renew(self):
+        """ Push the expiry back to ttl seconds, return False when the lock is no longer ours """
+        return bool(self._renew_script(keys=[self.name], args=[self.token, int(self.ttl * 1000)]))
+
+    def check(self):
+        """ Raise LockLost when the heartbeat found the lock no longer ours """
+        if self.lost:
+            raise LockLost(f'Lock {self.name} expired and is no longer owned by this worker')
+
+    def release(self):
+        """ Stop the heartbeat and delete the lock if it is still ours """
+        if self._heartbeat is None:
+            return
+        self._stop_heartbeat.set()
+        self._heartbeat.join()
+        self._heartbeat = None
+        self._release_script(keys=[self.name], args=[self.token])
+
+    def _renew_until_released(self):
+        while not self._stop_heartbeat.wait(self.ttl / 3):
+            try:
+                if not self.renew():
+                    self.lost = True
+                    print(f'Lock {self.name} expired and is no longer owned by this worker')
+                    return
+            except Exception as e:
+                # A Redis hiccup is retried at the next beat, the lock lives for ttl seconds anyway
+                print(f'Failed to renew lock {self.name}. Reason: {e}')
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import json
+
+
+DONE = 'done'
+FAILED = 'failed'
+QUARANTINED = 'quarantined'
+
+
+# Function to name the manifest of a trajectory and method within an event
+def manifest_key(event_id, filename, method):
+    return f'manifest:{event_id}:{filename}:{method}'
+
+
+class FrameManifest:
+    """ Completion state of the frames of one trajectory and one method of an event
+
+        The manifest is a Redis hash with one field per frame holding its state, its
+        number of failed attempts and, once done, its parsed result. It outlives the
+        tasks computing the frames, so a retried or redelivered task only computes
+        the frames that are not done yet. A frame failing max_attempts times is
+        quarantined: it is not tried again and is reported instead.
+
+        Parameters:
+
+        client(redis.Redis): Redis connection
+        key(str): key of the hash, see manifest_key
+        max_attempts(int): failed attempts before a frame is quarantined
+        ttl(int): seconds the manifest is kept after its last update
+    """
+
+    def __init__(self, client, key, max_attempts=3, ttl=7 * 24 * 3600):
+        self.client = client
+        self.key = key
+        self.max_attempts = max_attempts
+        self.ttl = ttl
+
+    def load(self):
+        """ Return the entries of every frame seen so far, keyed by frame """
+        return {int(frame): json.loads(entry) for frame, entry in self.client.hgetall(self.key).items()}
+
+    def _store(self, frame, entry):
+        pipeline = self.client.pipeline()
+        pipeline.hset(self.key, str(frame), json.dumps(entry))
+        pipeline.expire(self.key, self.ttl)
+        pipeline.execute()
+
+    def done(self, frame, record):
+        self._store(frame, {'state': DONE, 'record': record})
+
+    def failed(self, frame, error, previous=None):
+        """ Count a failed attempt of a frame, quarantining it after max_attempts
+
+            Return:
+
+            dict: the new entry of the frame
+        """
+        attempts = (previous or {}).get('attempts', 0) + 1
+        entry = {'state': QUARANTINED if attempts >= self.max_attempts else FAILED, 'attempts': attempts, 'error': error}
+        self._store(frame, entry)
+        return entry
+
+    def delete(self):
+        self.client.delete(self.key)
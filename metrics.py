@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+
+
+class Metrics:
+    """ Timers and counters of the pipeline stages
+
+        A timer keeps the number of observations, their total and their maximum in
+        seconds, a counter a running total. Observations are a few dictionary
+        operations under a lock, cheap enough to stay on in production.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self.timers.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+            timer['count'] += 1
+            timer['seconds'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def to_dict(self):
+        with self._lock:
+            return {'timers': {name: dict(timer) for name, timer in self.timers.items()},
+                    'counters': dict(self.counters)}
+
+    def merge(self, data):
+        """ Add the timers and counters of another Metrics, given as its to_dict() """
+        with self._lock:
+            for name, other in data.get('timers', {}).items():
+                timer = self.timers.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+                timer['count'] += other['count']
+                timer['seconds'] += other['seconds']
+                timer['max'] = max(timer['max'], other['max'])
+            for name, value in data.get('counters', {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+
+# Metrics of the task running in this process, and of every task this process ran
+current = Metrics()
+totals = Metrics()
+# Metrics of the tasks whose run was interrupted by a nested task, as eager tasks are
+_suspended = []
+
+
+def reset():
+    """ Start the metrics of a new task """
+    global current
+    current = Metrics()
+    return current
+
+
+def push():
+    """ Start the metrics of a task run inside another one, keeping those of the outer task """
+    _suspended.append(current)
+    return reset()
+
+
+def pop():
+    """ Go back to the metrics of the outer task once a nested task is done """
+    global current
+    finished = current
+    current = _suspended.pop() if _suspended else Metrics()
+    return finished
+
+
+def stage(name):
+    """ Time a block of code as the stage name of the current task """
+    return current.stage(name)
+
+
+def observe(name, seconds):
+    current.observe(name, seconds)
+
+
+def increment(name, amount=1):
+    current.increment(name, amount)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Function to name the Prometheus textfile of this process
+def prometheus_textfile_path(directory, prefix='trajectory_pipeline'):
+    return os.path.join(directory, f'{prefix}_{socket.gethostname()}_{os.getpid()}.prom')
+
+
+# Function to export metrics in the Prometheus text format
+def write_prometheus_textfile(directory, metrics, prefix='trajectory_pipeline', labels=None):
+    """ Function to write metrics as a Prometheus textfile for the node exporter
+
+        Every worker process writes its own file, replaced atomically, holding the
+        totals of the tasks it ran. The process removes it when it exits (see
+        remove_prometheus_textfile).
+
+        Parameters:
+
+        directory(str): textfile collector directory of the node exporter
+        metrics(Metrics): metrics to export
+        prefix(str): prefix of the metric names
+        labels(dict): labels added to every sample
+
+        Return:
+
+        str: path of the written file
+    """
+    labels = dict(labels or {}, host=socket.gethostname(), pid=os.getpid())
+    label_text = ','.join(f'{name}="{_escape(value)}"' for name, value in sorted(labels.items()))
+    data = metrics.to_dict()
+
+    lines = [
+        f'# HELP {prefix}_stage_seconds_total Time spent in each pipeline stage.',
+        f'# TYPE {prefix}_stage_seconds_total counter',
+    ]
+    lines += [f'{prefix}_stage_seconds_total{{{label_text},stage="{_escape(name)}"}} {timer["seconds"]:.6f}'
+              for name, timer in sorted(data['timers'].items())]
+    lines += [
+        f'# HELP {prefix}_stage_calls_total Number of times each pipeline stage ran.',
+        f'# TYPE {prefix}_stage_calls_total counter',
+    ]
+    lines += [f'{prefix}_stage_calls_total{{{label_text},stage="{_escape(name)}"}} {timer["count"]}'
+              for name, timer in sorted(data['timers'].items())]
+    lines += [
+        f'# HELP {prefix}_stage_max_seconds Longest single run of each pipeline stage.',
+        f'# TYPE {prefix}_stage_max_seconds gauge',
+    ]
+    lines += [f'{prefix}_stage_max_seconds{{{label_text},stage="{_escape(name)}"}} {timer["max"]:.6f}'
+              for name, timer in sorted(data['timers'].items())]
+    lines += [
+        f'# HELP {prefix}_events_total Pipeline counters (frames computed, cache hits, ...).',
+        f'# TYPE {prefix}_events_total counter',
+    ]
+    lines += [f'{prefix}_events_total{{{label_text},name="{_escape(name)}"}} {value}'
+              for name, value in sorted(data['counters'].items())]
+
+    os.makedirs(directory, exist_ok=True)
+    path = prometheus_textfile_path(directory, prefix)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+    return path
+
+
+# Function to remove the Prometheus textfile of this process
+def remove_prometheus_textfile(directory, prefix='trajectory_pipeline'):
+    """ Function to remove the textfile of an exiting process, so the node exporter
+        stops serving its totals and the files of past processes do not pile up """
+    try:
+        os.remove(prometheus_textfile_path(directory, prefix))
+    except FileNotFoundError:
+        pass
+
+
+# Function to write the report of one webhook event
+def write_event_report(path, report):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return path
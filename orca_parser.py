@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import multiprocessing as mp
+from dataclasses import dataclass, field, asdict
+from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor
+
+
+HARTREE_TO_EV = 27.211386245988
+
+# Number of bytes read from the end of a log to find the trailer fields
+TRAILER_SIZE = 4096
+
+state_pattern = re.compile(r'^\s*STATE\s+(\d+):\s+E=\s+(-?\d+\.\d+)\s+au')
+scf_iterations_pattern = re.compile(r'SCF (NOT )?CONVERGED AFTER\s+(\d+)\s+CYCLES')
+run_time_pattern = re.compile(r"TOTAL RUN TIME:\s+(\d+) days\s+(\d+) hours\s+(\d+) minutes\s+(\d+) seconds\s+(\d+) msec")
+
+
+@dataclass
+class ExcitedState:
+    """ One excited state: its number, its excitation energy in eV and its oscillator strength """
+    state: int
+    energy: float
+    oscillator_strength: Optional[float] = None
+
+
+@dataclass
+class OrcaResult:
+    """ Everything the pipeline reads from one ORCA log
+
+        Energies are in eV and run_time in minutes. A field missing from the log,
+        for example run_time when ORCA was killed, is None.
+    """
+    log_path: str
+    lowest_energy: Optional[float] = None
+    scf_energy: Optional[float] = None
+    scf_converged: Optional[bool] = None
+    scf_iterations: Optional[int] = None
+    excited_states: List[ExcitedState] = field(default_factory=list)
+    run_time: Optional[float] = None
+    terminated_normally: bool = False
+
+    @property
+    def es_energy(self):
+        """ Energy of the lowest excited state, as the pipeline always stored it """
+        if self.lowest_energy is not None:
+            return self.lowest_energy
+        return self.excited_states[0].energy if self.excited_states else None
+
+    @property
+    def complete(self):
+        return self.es_energy is not None and self.scf_energy is not None
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def _parse_absorption_row(fields):
+    # ORCA 5:  '1   39650.3   252.2   0.000000000   ...'
+    if fields[0].isdigit() and len(fields) >= 4:
+        return int(fields[0]), float(fields[3])
+    # ORCA 6:  '0-1A  ->  1-1A   4.916   39650.3   252.2   0.000000000   ...'
+    if len(fields) >= 7 and fields[1] == '->':
+        return int(fields[2].split('-')[0]), float(fields[6])
+    return None
+
+
+def _read_trailer(log_file, result):
+    log_file.seek(0, os.SEEK_END)
+    size = log_file.tell()
+    log_file.seek(max(size - TRAILER_SIZE, 0))
+    trailer = log_file.read().decode('utf-8', 'replace')
+
+    result.terminated_normally = 'ORCA TERMINATED NORMALLY' in trailer
+    match = run_time_pattern.search(trailer)
+    if match:
+        days, hours, minutes, seconds, mseconds = (float(value) for value in match.groups())
+        result.run_time = (days * 86400 + hours * 3600 + minutes * 60 + seconds + mseconds / 1000) / 60
+
+
+# Function to parse an ORCA log
+def parse_orca_log(log_path):
+    """ Function to read an ORCA log once and extract everything the pipeline needs
+
+        The body of the log is read forwards until the absorption spectrum has been
+        parsed, then the trailer (TOTAL RUN TIME, normal termination) is read from
+        the end of the file without scanning what is in between.
+
+        Parameters:
+
+        log_path(str): path of the ORCA log
+
+        Return:
+
+        OrcaResult: parsed fields, missing ones are None
+    """
+    result = OrcaResult(log_path=log_path)
+    states = {}
+    in_spectrum = False
+    spectrum_rows = 0
+
+    with open(log_path, 'rb') as log_file:
+        for raw_line in log_file:
+            line = raw_line.decode('utf-8', 'replace')
+
+            if in_spectrum:
+                parsed = _parse_absorption_row(line.split()) if line.strip() else None
+                if parsed is not None:
+                    state, oscillator_strength = parsed
+                    spectrum_rows += 1
+                    if state in states:
+                        states[state].oscillator_strength = oscillator_strength
+                elif not line.strip() and spectrum_rows:
+                    # Blank line after the rows closes the table, nothing after it is needed
+                    break
+                continue
+
+            if result.scf_iterations is None and 'CONVERGED AFTER' in line:
+                match = scf_iterations_pattern.search(line)
+                if match:
+                    result.scf_converged = match.group(1) is None
+                    result.scf_iterations = int(match.group(2))
+
+            elif result.scf_energy is None and 'E(SCF)' in line:
+                result.scf_energy = float(line.split()[2]) * HARTREE_TO_EV
+
+            elif result.lowest_energy is None and 'Lowest Energy' in line:
+                result.lowest_energy = float(line.split()[3]) * HARTREE_TO_EV
+
+            elif 'STATE' in line:
+                match = state_pattern.match(line)
+                if match and int(match.group(1)) not in states:
+                    states[int(match.group(1))] = ExcitedState(int(match.group(1)), float(match.group(2)) * HARTREE_TO_EV)
+
+            elif 'ABSORPTION SPECTRUM VIA TRANSITION ELECTRIC DIPOLE MOMENTS' in line:
+                in_spectrum = True
+
+        _read_trailer(log_file, result)
+
+    result.excited_states = [states[state] for state in sorted(states)]
+    return result
+
+
+# Function to parse many ORCA logs at once
+def parse_orca_logs(log_paths, processes=None):
+    """ Function to parse many ORCA logs in a process pool
+
+        Daemonic processes such as the Celery prefork workers cannot start a pool,
+        the logs are then parsed one after the other.
+
+        Parameters:
+
+        log_paths(list): paths of the ORCA logs
+        processes(int): size of the pool, defaults to every core
+
+        Return:
+
+        list: OrcaResult in the order of log_paths
+    """
+    log_paths = list(log_paths)
+    if len(log_paths) < 2 or mp.current_process().daemon:
+        return [parse_orca_log(log_path) for log_path in log_paths]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(parse_orca_log, log_paths, chunksize=16))
+
+
+# Function to parse every ORCA log of a directory
+def parse_directory(directory, processes=None):
+    """ Function to parse every .log file of a directory in a process pool
+
+        Return:
+
+        dict: OrcaResult of every log, keyed by log path
+    """
+    log_paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.log'))
+    return dict(zip(log_paths, parse_orca_logs(log_paths, processes)))
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import hashlib
+import subprocess
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from os.path import basename
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+pal_block_pattern = re.compile(r'%pal\b.*?\bnprocs\s+(\d+)', re.IGNORECASE | re.DOTALL)
+pal_keyword_pattern = re.compile(r'^\s*!.*?\bPAL(\d+)\b', re.IGNORECASE | re.MULTILINE)
+# Blocks and keywords that only act after the SCF or only set the resources of the run
+post_scf_blocks = {'tddft', 'cis', 'pal', 'maxcore', 'moinp'}
+resource_keyword_pattern = re.compile(r'^(PAL\d+|MOREAD)$', re.IGNORECASE)
+
+
+# Function to read how many cores an ORCA template asks for
+def template_nprocs(template_contents):
+    """ Function to read the number of processes requested by an ORCA template,
+        either through a '%pal nprocs N end' block or a '! PALN' keyword
+
+        Parameters:
+
+        template_contents(str): contents of the ORCA template
+
+        Return:
+
+        int: number of processes, 1 when the template runs serially
+    """
+    match = pal_block_pattern.search(template_contents) or pal_keyword_pattern.search(template_contents)
+    return int(match.group(1)) if match else 1
+
+
+# Function to tell which templates converge the same ground state
+def scf_signature(template_contents):
+    """ Function to summarize what determines the SCF of an ORCA template: its
+        '!' keywords but PALN and MORead, and its blocks but %tddft, %cis, %pal,
+        %maxcore and %moinp, compared regardless of case, order and spacing.
+        Templates with the same signature converge the same orbitals on a geometry,
+        so one of them can start from the .gbw of another.
+
+        Parameters:
+
+        template_contents(str): contents of the ORCA template
+
+        Return:
+
+        str: digest of the SCF settings
+    """
+    keywords = set()
+    blocks = []
+    block = None
+    for line in template_contents.splitlines():
+        tokens = line.split('#', 1)[0].lower().split()
+        if not tokens:
+            continue
+        if block is None and tokens[0].startswith('!'):
+            tokens = [tokens[0][1:]] + tokens[1:]
+            keywords.update(token for token in tokens if token and not resource_keyword_pattern.match(token))
+            continue
+        if block is None and tokens[0].startswith('%'):
+            block = tokens
+            # %maxcore and %moinp hold a single value, the other blocks run up to their 'end'
+            if tokens[0][1:] not in ('maxcore', 'moinp') and tokens[-1] != 'end':
+                continue
+        elif block is not None:
+            block = block + tokens
+            if tokens[-1] != 'end':
+                continue
+        else:
+            # Coordinates or anything else outside of a block
+            blocks.append(' '.join(tokens))
+            continue
+        if block[0][1:] not in post_scf_blocks:
+            blocks.append(' '.join(block))
+        block = None
+    settings = ' '.join(sorted(keywords)) + '\n' + '\n'.join(sorted(blocks))
+    return hashlib.sha256(settings.encode('utf-8')).hexdigest()[:12]
+
+
+class ResourceBudget:
+    """ Cores and memory of the node shared by the ORCA runs
+
+        A job holds its cores and its memory until it releases them, so the sum of
+        the running jobs' %pal nprocs and nprocs * %maxcore never exceeds the budget.
+        A job asking for more than the whole budget is given the whole budget.
+
+        Parameters:
+
+        total_cores(int): number of cores the jobs may use together
+        total_memory(int): memory in MB the jobs may use together, None does not limit memory
+    """
+
+    def __init__(self, total_cores, total_memory=None):
+        self.total = max(int(total_cores), 1)
+        self.total_memory = total_memory
+        self.free = self.total
+        self.free_memory = total_memory
+        self._condition = threading.Condition()
+
+    def _request(self, cores, memory):
+        cores = min(max(cores, 1), self.total)
+        memory = 0 if self.total_memory is None else min(max(memory or 0, 0), self.total_memory)
+        return cores, memory
+
+    def _fits(self, cores, memory):
+        return self.free >= cores and (self.total_memory is None or self.free_memory >= memory)
+
+    def _take(self, cores, memory):
+        self.free -= cores
+        if self.total_memory is not None:
+            self.free_memory -= memory
+
+    def acquire(self, cores, memory=0):
+        cores, memory = self._request(cores, memory)
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(cores, memory))
+            self._take(cores, memory)
+        return cores, memory
+
+    def try_acquire(self, cores, memory=0):
+        """ Take the resources if they are free right now, return them or None """
+        cores, memory = self._request(cores, memory)
+        with self._condition:
+            if not self._fits(cores, memory):
+                return None
+            self._take(cores, memory)
+        return cores, memory
+
+    def release(self, acquired):
+        cores, memory = acquired
+        with self._condition:
+            self.free += cores
+            if self.total_memory is not None:
+                self.free_memory += memory
+            self._condition.notify_all()
+
+    @contextmanager
+    def resources(self, cores, memory=0):
+        acquired = self.acquire(cores, memory)
+        try:
+            yield acquired
+        finally:
+            self.release(acquired)
+
+
+class OrcaJob:
+    """ One ORCA run: an input file, the log it writes and the resources it needs
+
+        Parameters:
+
+        frame(int): frame number the job belongs to
+        input_path(str): path of the .inp file
+        log_path(str): path of the log file ORCA's stdout goes to
+        nprocs(int): number of cores used by the run (%pal nprocs)
+        memory(int): memory in MB used by the run (nprocs * %maxcore), 0 when unknown
+        cost(float): estimated CPU seconds, the most expensive jobs are started first
+        timeout(float): wall-clock seconds after which the run is killed, None never kills it
+        method(str): template the job runs, None when a single one runs
+    """
+
+    def __init__(self, frame, input_path, log_path, nprocs=1, memory=0, cost=0, timeout=None, method=None):
+        self.frame = frame
+        self.method = method
+        self.input_path = input_path
+        self.log_path = log_path
+        self.nprocs = nprocs
+        self.memory = memory
+        self.cost = cost
+        self.timeout = timeout
+        self.timed_out = False
+        self.wall_time = None
+        self.cpu_time = None
+        self.max_rss_mb = None
+
+    def __repr__(self):
+        return f'OrcaJob(frame={self.frame}, method={self.method!r}, input_path={self.input_path!r}, nprocs={self.nprocs})'
+
+
+# Function to kill an ORCA run and every process it started
+def _kill_timed_out(process, job):
+    job.timed_out = True
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+# Function to run ORCA on one input file
+def run_orca(orca_path, job):
+    """ Function to run ORCA on one job, in the directory of its input file
+
+        The wall-clock time and the CPU time of ORCA and of the processes it waited
+        for (its MPI ranks) are stored on the job as wall_time and cpu_time, the
+        peak memory of the largest of these processes as max_rss_mb. ORCA runs in a
+        session of its own, so a run exceeding job.timeout is killed together with
+        its MPI ranks and marked timed_out.
+
+        Parameters:
+
+        orca_path(str): path of the ORCA executable, ORCA needs the full path to run in parallel
+        job(OrcaJob): job to run
+
+        Return:
+
+        int: return code of ORCA
+    """
+    working_directory = os.path.dirname(os.path.abspath(job.input_path))
+    start = time.perf_counter()
+    with open(job.log_path, 'w') as log_file, tempfile.TemporaryFile() as error_file:
+        process = subprocess.Popen([orca_path, basename(job.input_path)], cwd=working_directory,
+                                   stdout=log_file, stderr=error_file, start_new_session=True)
+        timer = None
+        if job.timeout:
+            timer = threading.Timer(job.timeout, _kill_timed_out, args=(process, job))
+            timer.daemon = True
+            timer.start()
+        # wait4 instead of wait to get the resource usage of this child only
+        _, status, usage = os.wait4(process.pid, 0)
+        if timer is not None:
+            timer.cancel()
+        process.returncode = os.waitstatus_to_exitcode(status)
+        job.wall_time = time.perf_counter() - start
+        job.cpu_time = usage.ru_utime + usage.ru_stime
+        job.max_rss_mb = usage.ru_maxrss / 1024
+        if process.returncode != 0:
+            error_file.seek(0)
+            print(f"Error running Orca command: {orca_path} {job.input_path}")
+            print(f"Return code: {process.returncode}" + (f", killed after {job.timeout} seconds" if job.timed_out else ''))
+            print(f"Error output: {error_file.read().decode('utf-8', 'replace')}")
+    return process.returncode
+
+
+# Function to run many jobs at once within the cores and memory of the node
+def run_jobs(jobs, worker, total_cores=None, total_memory=None, on_done=None):
+    """ Function to run worker(job) for every job concurrently while keeping the sum
+        of the running jobs' nprocs and memory within the budget
+
+        Jobs are packed first fit decreasing: whenever resources are released, the
+        most expensive waiting job that fits is started, so a large job waiting for
+        cores does not hold back the small ones that fit meanwhile.
+
+        Parameters:
+
+        jobs(list): OrcaJob (or anything with nprocs and optional memory and cost attributes) to run
+        worker(callable): function called with one job, runs it and returns its result
+        total_cores(int): core budget, defaults to every core of the node
+        total_memory(int): memory budget in MB, None does not limit memory
+        on_done(callable): called with each job and its result as soon as it finished,
+                           in the calling thread
+
+        Return:
+
+        list: results of worker in the order of jobs, whichever job finished first
+    """
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    budget = ResourceBudget(total_cores or os.cpu_count() or 1, total_memory)
+    # Waiting jobs grouped by the resources they ask for, most expensive first (sorted is stable)
+    waiting = {}
+    for i in sorted(range(len(jobs)), key=lambda i: -(getattr(jobs[i], 'cost', 0) or 0)):
+        waiting.setdefault((jobs[i].nprocs, getattr(jobs[i], 'memory', 0)), deque()).append(i)
+    results = [None] * len(jobs)
+
+    with ThreadPoolExecutor(max_workers=min(budget.total, len(jobs))) as pool:
+        running = {}
+        while waiting or running:
+            started = True
+            while started:
+                started = False
+                for shape in sorted(waiting, key=lambda shape: -(getattr(jobs[waiting[shape][0]], 'cost', 0) or 0)):
+                    acquired = budget.try_acquire(*shape)
+                    if acquired is not None:
+                        i = waiting[shape].popleft()
+                        if not waiting[shape]:
+                            del waiting[shape]
+                        running[pool.submit(worker, jobs[i])] = (i, acquired)
+                        started = True
+                        break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, acquired = running.pop(future)
+                budget.release(acquired)
+                results[i] = future.result()
+                if on_done is not None:
+                    on_done(jobs[i], results[i])
+    return results
+
+
+class OrcaChain:
+    """ Consecutive jobs run one after the other, each one starting its SCF from the
+        converged orbitals of the previous one. A chain is scheduled like a single
+        job holding the cores and memory of its largest job.
+
+        Parameters:
+
+        jobs(list): OrcaJob of contiguous frames, in frame order
+    """
+
+    def __init__(self, jobs):
+        self.jobs = list(jobs)
+        self.nprocs = max(job.nprocs for job in self.jobs)
+        self.memory = max(job.memory for job in self.jobs)
+        self.cost = sum(job.cost for job in self.jobs)
+
+    def __repr__(self):
+        return f'OrcaChain(frames={self.jobs[0].frame}-{self.jobs[-1].frame}, nprocs={self.nprocs})'
+
+
+# Function to cut jobs into contiguous chains that can run side by side
+def make_chains(jobs, total_cores=None, key=None):
+    """ Function to cut the jobs into as many contiguous blocks as can run at once
+        within the core budget
+
+        Parameters:
+
+        jobs(list): OrcaJob in the order they run
+        total_cores(int): core budget, defaults to every core of the node
+        key(callable): consecutive jobs with the same key(job) are never cut apart,
+                       every job is a unit of its own when None
+
+        Return:
+
+        list: OrcaChain, one per block
+    """
+    units = []
+    for job in jobs:
+        if key is not None and units and key(units[-1][-1]) == key(job):
+            units[-1].append(job)
+        else:
+            units.append([job])
+    if not units:
+        return []
+    total_cores = total_cores or os.cpu_count() or 1
+    num_chains = min(max(total_cores // max(job.nprocs for unit in units for job in unit), 1), len(units))
+    size, remainder = divmod(len(units), num_chains)
+    chains = []
+    start = 0
+    for i in range(num_chains):
+        stop = start + size + (1 if i < remainder else 0)
+        chains.append(OrcaChain([job for unit in units[start:stop] for job in unit]))
+        start = stop
+    return chains
+
+
+# Function to seed the SCF of a job with the orbitals of the job before it
+def seed_initial_guess(job, previous_job):
+    """ Function to make job read its initial guess from the .gbw written by
+        previous_job (MORead). The orbitals are copied to '<name>.guess.gbw' since
+        ORCA cannot read its guess from the .gbw it is about to overwrite.
+
+        Return:
+
+        bool: True when the guess was seeded, False when previous_job left no .gbw
+    """
+    previous_gbw = os.path.splitext(previous_job.input_path)[0] + '.gbw'
+    if not os.path.isfile(previous_gbw):
+        return False
+    guess_gbw = os.path.splitext(job.input_path)[0] + '.guess.gbw'
+    shutil.copyfile(previous_gbw, guess_gbw)
+    with open(job.input_path) as input_file:
+        input_contents = input_file.read()
+    with open(job.input_path, 'w') as input_file:
+        input_file.write(f'! MORead\n%moinp "{basename(guess_gbw)}"\n' + input_contents)
+    return True
+
+
+# Function to run the jobs of a chain one after the other
+def run_chain(orca_path, chain, on_job=None):
+    """ Function to run a chain, the first job from a cold start and every following
+        job from the orbitals of the job before it (the previous frame, or the same
+        frame with another template of the same scf_signature), calling
+        on_job(job, warm started) after every job
+
+        Return:
+
+        list: (return code, warm started) of every job of the chain
+    """
+    results = []
+    previous_job = None
+    for job in chain.jobs:
+        # A failed run may leave a .gbw behind that is not worth starting from
+        warm = previous_job is not None and results[-1][0] == 0 and seed_initial_guess(job, previous_job)
+        results.append((run_orca(orca_path, job), warm))
+        if on_job is not None:
+            on_job(job, warm)
+        previous_job = job
+    return results
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+""" Live results and progress of the webhook events
+
+    Every frame is appended to the Redis stream RESULTS_STREAM as soon as it is
+    parsed, together with the start and the publication of every event, so
+    downstream jobs can consume the labels before the final push:
+
+        python progress.py tail --repo molecule_repo
+        python progress.py status molecule_repo:main:<commit>
+        python progress.py aggregate --event molecule_repo:main:<commit>
+"""
+
+import sys
+import json
+import time
+import argparse
+
+import redis
+
+
+RESULTS_STREAM = 'trajectory_pipeline:results'
+FRAME_FIELDS = ('es_energy', 'gs_energy', 'run_time', 'scf_iterations', 'orca_wall_time')
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _field(value):
+    """ Stream fields cannot be None or nested, these are written as '' and JSON """
+    if value is None:
+        return ''
+    if isinstance(value, (list, dict, bool)):
+        return json.dumps(value)
+    return value
+
+
+class EventProgress:
+    """ Progress of one webhook event and stream of its results
+
+        The event is described by the Redis hash 'progress:<event_id>' (repository,
+        branch, total frames as frames times methods, start time and summed ORCA
+        wall time) and its frames by the sets 'progress:<event_id>:done', ':resumed'
+        (done by an earlier attempt at the event) and ':quarantined', so a frame
+        reported twice by a redelivered task is counted once. The ETA comes from the
+        rate at which the frames of this attempt were done.
+
+        Parameters:
+
+        client(redis.Redis): Redis connection
+        event_id(str): identifier of the event
+        stream(str): stream the results are appended to
+        maxlen(int): approximate number of entries the stream keeps
+        ttl(int): seconds the counters are kept after their last update
+    """
+
+    def __init__(self, client, event_id, stream=RESULTS_STREAM, maxlen=1000000, ttl=7 * 24 * 3600):
+        self.client = client
+        self.event_id = event_id
+        self.stream = stream
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self.key = f'progress:{event_id}'
+        self.sets = {name: f'{self.key}:{name}' for name in ('done', 'resumed', 'quarantined')}
+
+    def _append(self, pipeline, fields):
+        fields = dict(fields, event=self.event_id, time=time.time())
+        pipeline.xadd(self.stream, {name: _field(value) for name, value in fields.items()},
+                      maxlen=self.maxlen, approximate=True)
+
+    def _expire(self, pipeline):
+        for key in (self.key, *self.sets.values()):
+            pipeline.expire(key, self.ttl)
+
+    def start(self, repo_name, branch_name, total_frames):
+        pipeline = self.client.pipeline()
+        pipeline.delete(self.key, *self.sets.values())
+        pipeline.hset(self.key, mapping={'repository': repo_name, 'branch': branch_name, 'total': total_frames,
+                                         'orca_wall_time': 0.0, 'started': time.time()})
+        self._expire(pipeline)
+        self._append(pipeline, {'type': 'event_started', 'repository': repo_name, 'branch': branch_name,
+                                'total': total_frames})
+        pipeline.execute()
+
+    def resumed(self, filename, method, done_frames, quarantined_frames=()):
+        """ Count the frames done or quarantined by an earlier attempt at the event, they are not streamed again """
+        done = [f'{filename}:{method}:{frame}' for frame in done_frames]
+        if done:
+            # Frames this attempt already counted are not resumed ones
+            counted = self.client.smismember(self.sets['done'], done)
+            resumed = [member for member, is_counted in zip(done, counted) if not is_counted]
+            if resumed:
+                self.client.sadd(self.sets['done'], *resumed)
+                self.client.sadd(self.sets['resumed'], *resumed)
+        if quarantined_frames:
+            self.client.sadd(self.sets['quarantined'], *(f'{filename}:{method}:{frame}' for frame in quarantined_frames))
+
+    def frame_done(self, filename, method, record):
+        pipeline = self.client.pipeline()
+        self._append(pipeline, dict({name: record.get(name) for name in FRAME_FIELDS}, type='frame', file=filename,
+                                    method=method, frame=record['frame'], excited_states=record.get('excited_states')))
+        pipeline.sadd(self.sets['done'], f"{filename}:{method}:{record['frame']}")
+        pipeline.hincrbyfloat(self.key, 'orca_wall_time', record.get('orca_wall_time') or 0.0)
+        self._expire(pipeline)
+        pipeline.execute()
+
+    def frame_quarantined(self, filename, method, frame, error):
+        pipeline = self.client.pipeline()
+        self._append(pipeline, {'type': 'frame_quarantined', 'file': filename, 'method': method, 'frame': frame,
+                                'error': error})
+        pipeline.sadd(self.sets['quarantined'], f'{filename}:{method}:{frame}')
+        self._expire(pipeline)
+        pipeline.execute()
+
+    def finish(self, **fields):
+        pipeline = self.client.pipeline()
+        self._append(pipeline, dict(fields, type='event_finished'))
+        pipeline.hset(self.key, 'finished', time.time())
+        pipeline.execute()
+
+    def snapshot(self):
+        """ Return the counters of the event with its percentage done, the mean ORCA
+            wall time of a frame and the ETA in seconds (None until a frame is done) """
+        pipeline = self.client.pipeline()
+        pipeline.hgetall(self.key)
+        for key in self.sets.values():
+            pipeline.scard(key)
+        hash_values, done, resumed, quarantined = pipeline.execute()
+        values = {_text(name): _text(value) for name, value in hash_values.items()}
+        if not values:
+            return None
+        total = int(values['total'])
+        computed = done - resumed
+        end = float(values['finished']) if 'finished' in values else time.time()
+        elapsed = end - float(values['started'])
+        remaining = max(total - done - quarantined, 0)
+        return {
+            'event': self.event_id,
+            'repository': values['repository'],
+            'branch': values['branch'],
+            'total': total,
+            'done': done,
+            'resumed': resumed,
+            'quarantined': quarantined,
+            'percent': 100.0 * (done + quarantined) / total if total else 100.0,
+            'elapsed': elapsed,
+            'mean_frame_seconds': float(values['orca_wall_time']) / computed if computed > 0 else None,
+            'eta': remaining * elapsed / computed if computed > 0 else None,
+            'finished': 'finished' in values,
+        }
+
+
+# Function to read the entries of the results stream
+def read_results(client, stream=RESULTS_STREAM, start='0', follow=False, block=5000):
+    """ Function to iterate over the entries of the results stream as dicts, from
+        the entry after start ('$' for new entries only), waiting for new entries
+        when follow is set """
+    last_id = start
+    while True:
+        if follow:
+            response = client.xread({stream: last_id}, block=block, count=1000)
+            entries = response[0][1] if response else []
+        else:
+            entries = client.xrange(stream, min=f'({last_id}' if last_id != '0' else '-', count=1000)
+            if not entries:
+                return
+        for entry_id, fields in entries:
+            last_id = _text(entry_id)
+            yield dict({_text(name): _text(value) for name, value in fields.items()}, id=last_id)
+
+
+def _matches(entry, args):
+    return ((args.event is None or entry.get('event') == args.event) and
+            (args.repo is None or entry.get('event', '').split(':')[0] == args.repo))
+
+
+# Function to summarize the frames of the stream per event, trajectory and method
+def aggregate(entries):
+    summary = {}
+    for entry in entries:
+        if entry.get('type') not in ('frame', 'frame_quarantined'):
+            continue
+        group = summary.setdefault((entry['event'], entry['file'], entry['method']),
+                                   {'frames': 0, 'quarantined': 0, 'es_energy': [], 'orca_wall_time': 0.0})
+        if entry['type'] == 'frame_quarantined':
+            group['quarantined'] += 1
+            continue
+        group['frames'] += 1
+        if entry.get('es_energy'):
+            group['es_energy'].append(float(entry['es_energy']))
+        if entry.get('orca_wall_time'):
+            group['orca_wall_time'] += float(entry['orca_wall_time'])
+
+    rows = []
+    for (event, filename, method), group in sorted(summary.items()):
+        energies = group.pop('es_energy')
+        rows.append(dict(group, event=event, file=filename, method=method,
+                         es_energy_mean=sum(energies) / len(energies) if energies else None,
+                         es_energy_min=min(energies, default=None), es_energy_max=max(energies, default=None)))
+    return rows
+
+
+# Main function to follow the events from the command line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Follow the results and progress of the trajectory pipeline')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/0')
+    parser.add_argument('--stream', default=RESULTS_STREAM)
+    commands = parser.add_subparsers(dest='command', required=True)
+    tail = commands.add_parser('tail', help='print the results as JSON lines as they are produced')
+    tail.add_argument('--from-start', action='store_true', help='print the entries already in the stream first')
+    status = commands.add_parser('status', help='print the progress of an event')
+    status.add_argument('event_id')
+    summary = commands.add_parser('aggregate', help='summarize the frames in the stream per trajectory and method')
+    for command in (tail, summary):
+        command.add_argument('--event', default=None, help='only this event')
+        command.add_argument('--repo', default=None, help='only the events of this repository')
+    args = parser.parse_args()
+
+    client = redis.Redis.from_url(args.redis_url)
+    if args.command == 'status':
+        progress = EventProgress(client, args.event_id, args.stream).snapshot()
+        if progress is None:
+            sys.exit(f'No progress recorded for {args.event_id}')
+        print(json.dumps(progress, indent=2))
+    elif args.command == 'tail':
+        try:
+            for entry in read_results(client, args.stream, '0' if args.from_start else '$', follow=True):
+                if _matches(entry, args):
+                    print(json.dumps(entry), flush=True)
+        except KeyboardInterrupt:
+            pass
+    else:
+        rows = aggregate(entry for entry in read_results(client, args.stream) if _matches(entry, args))
+        print(json.dumps(rows, indent=2))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+
+
+# Columns of the store, in order, with their dtype. Missing values are stored as NaN.
+COLUMNS = (
+    ('frame', np.int64),
+    ('es_energy', np.float64),
+    ('gs_energy', np.float64),
+    ('run_time', np.float64),
+)
+
+
+def _column_path(directory, name):
+    return os.path.join(directory, f'{name}.npy')
+
+
+# Function to write the per-frame results of one trajectory and one method
+def write_properties(directory, records):
+    """ Function to write per-frame results as one typed .npy array per column
+
+        Every array is written to a temporary file and renamed, so a reader never
+        sees a half written column.
+
+        Parameters:
+
+        directory(str): directory of the store, one per trajectory and method
+        records(list): one dict per frame with frame, es_energy, gs_energy and run_time
+
+        Return:
+
+        list: paths of the written column files
+    """
+    os.makedirs(directory, exist_ok=True)
+    records = sorted(records, key=lambda record: record['frame'])
+    written_files = []
+    for name, dtype in COLUMNS:
+        values = [np.nan if record.get(name) is None else record[name] for record in records]
+        column = np.asarray(values, dtype=dtype)
+        path = _column_path(directory, name)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, column)
+        os.replace(tmp_path, path)
+        written_files.append(path)
+    return written_files
+
+
+# Function to read a store
+def load_properties(directory, mmap=True):
+    """ Function to read the columns of a store
+
+        Parameters:
+
+        directory(str): directory of the store
+        mmap(bool): memory-map the arrays instead of reading them, so millions of
+                    frames can be opened without loading them
+
+        Return:
+
+        dict: array of every column, keyed by column name
+    """
+    return {name: np.load(_column_path(directory, name), mmap_mode='r' if mmap else None)
+            for name, _ in COLUMNS}
+
+
+def _format_value(value, spec=''):
+    return '' if np.isnan(value) else format(float(value), spec)
+
+
+# Function to export a store to the historical text layout
+def export_tsv(directory, es_energy_file, gs_energy_file, run_time_file):
+    """ Function to write a store in the text layout used before the store existed:
+        'frame<TAB>energy' lines for the energy files and one run time per line
+
+        Return:
+
+        list: paths of the written text files
+    """
+    columns = load_properties(directory)
+    for path in (es_energy_file, gs_energy_file, run_time_file):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    for path, name in ((es_energy_file, 'es_energy'), (gs_energy_file, 'gs_energy')):
+        with open(path, 'w') as f_out:
+            for frame, value in zip(columns['frame'], columns[name]):
+                f_out.write(f'{frame}\t{_format_value(value)}\n')
+
+    with open(run_time_file, 'w') as f_out:
+        for value in columns['run_time']:
+            f_out.write(f"{_format_value(value, '.6f')}\n")
+    return [es_energy_file, gs_energy_file, run_time_file]
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import random
+import subprocess
+
+
+# Messages of git push meaning the remote moved on and a pull is needed first
+non_fast_forward_messages = ('failed to update ref', 'failed to push', 'non-fast-forward', '[rejected]', 'fetch first')
+
+
+# Function to push using git
+def git_push(directory, remote, branch_name, max_attempts=5, base_delay=2.0):
+    """ Function to push a branch, pulling and retrying with exponential backoff
+        while the push is rejected because the remote moved on
+
+        Parameters:
+
+        directory(str): path of the git working tree
+        remote(str): name of the remote
+        branch_name(str): branch to push
+        max_attempts(int): number of pushes tried before giving up
+        base_delay(float): delay in seconds before the first retry, doubled at every retry
+
+        Return:
+
+        int: number of attempts the push took
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            subprocess.check_output(['git', 'push', remote, branch_name], cwd=directory, stderr=subprocess.STDOUT)
+            print("Push succeeded.")
+            return attempt
+        except subprocess.CalledProcessError as e:
+            output = e.output.decode('utf-8', 'replace')
+            if not any(message in output for message in non_fast_forward_messages) or attempt == max_attempts:
+                print(f"Push failed after {attempt} attempts: {output}")
+                raise
+            delay = base_delay * 2 ** (attempt - 1) * random.uniform(1, 1.5)
+            print(f"Push rejected. Pulling latest changes from remote repository and retrying in {delay:.1f} seconds.")
+            time.sleep(delay)
+            # The local commit is not pushed yet so the branches diverged: merge them (git >= 2.33 refuses to
+            # pull diverged branches without being told how) and skip the editor of the merge commit
+            subprocess.check_call(['git', 'pull', '--no-rebase', '--no-edit', remote, branch_name], cwd=directory)
+
+
+# Function to push data to Gitea repository and Azure cloud storage
+def publish_outputs(directory, output_files, branch_name, message='adding new data', lock=None):
+    """ Function to publish every output of an event at once: a single 'dvc add'
+        over all the files, a single commit and a single push
+
+        Parameters:
+
+        directory(str): path inside the git working tree of the data repository
+        output_files(list): files and directories to track with DVC
+        branch_name(str): branch to push
+        message(str): commit message
+        lock(DistributedLock): lock of the working tree, checked before the commit and the push
+
+        Return:
+
+        dict: seconds spent in dvc add, git commit and git push, and the number of push attempts
+    """
+    report = {'files': len(output_files), 'dvc_add': 0.0, 'git_commit': 0.0, 'git_push': 0.0, 'push_attempts': 0}
+    if not output_files:
+        print('Nothing to publish')
+        return report
+    remote = subprocess.check_output(['git', 'remote'], cwd=directory).decode('utf-8').split()[0]
+
+    start = time.perf_counter()
+    add_data = subprocess.check_output(['dvc', 'add'] + list(output_files), cwd=directory, universal_newlines=True)
+    print('newline :', add_data)
+    report['dvc_add'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # Stage the .dvc and .gitignore files 'dvc add' writes, whether or not core.autostage is set
+    tracking_files = sorted({path.rstrip('/') + '.dvc' for path in output_files} |
+                            {os.path.join(os.path.dirname(path.rstrip('/')), '.gitignore') for path in output_files})
+    subprocess.check_call(['git', 'add', '--'] + [path for path in tracking_files if os.path.exists(path)], cwd=directory)
+    staged = subprocess.run(['git', 'diff', '--cached', '--quiet'], cwd=directory).returncode != 0
+    # Another event may be using the working tree once the lock is lost, nothing is committed or pushed then
+    if lock is not None:
+        lock.check()
+    if staged:
+        commit = subprocess.check_output(['git', 'commit', '-m', message], cwd=directory, universal_newlines=True)
+        print('output :', commit)
+    report['git_commit'] = time.perf_counter() - start
+
+    if staged:
+        if lock is not None:
+            lock.check()
+        start = time.perf_counter()
+        report['push_attempts'] = git_push(directory, remote, branch_name)
+        report['git_push'] = time.perf_counter() - start
+
+    print(f"Published {report['files']} outputs: dvc add {report['dvc_add']:.1f} s, "
+          f"git commit {report['git_commit']:.1f} s, git push {report['git_push']:.1f} s "
+          f"({report['push_attempts']} attempts)")
+    return report
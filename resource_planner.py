@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import math
+import time
+import sqlite3
+import threading
+
+
+maxcore_pattern = re.compile(r'^\s*%maxcore\s+\d+\s*$\n?', re.IGNORECASE | re.MULTILINE)
+pal_block_pattern = re.compile(r'^\s*%pal\b.*?\bend\b[^\n]*\n?', re.IGNORECASE | re.MULTILINE | re.DOTALL)
+pal_keyword_pattern = re.compile(r'(^\s*!.*?)\s+PAL\d+\b', re.IGNORECASE | re.MULTILINE)
+
+
+# Function to read the memory the jobs of the node may use
+def available_memory_mb():
+    """ Return MemAvailable of /proc/meminfo in MB, the physical memory where it does not exist """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1024 ** 2
+
+
+# Function to set the cores and memory of an ORCA input
+def apply_resources(template_contents, nprocs, maxcore):
+    """ Function to replace the '%pal' block, '! PALN' keyword and '%maxcore' line
+        of a template with the given number of processes and memory per process
+
+        Parameters:
+
+        template_contents(str): contents of the ORCA template
+        nprocs(int): number of processes
+        maxcore(int): memory per process in MB
+
+        Return:
+
+        str: the input, starting with the '%pal' and '%maxcore' lines
+    """
+    contents = pal_block_pattern.sub('', template_contents)
+    contents = pal_keyword_pattern.sub(r'\1', contents)
+    contents = maxcore_pattern.sub('', contents)
+    return f'%pal nprocs {nprocs} end\n%maxcore {maxcore}\n' + contents
+
+
+class CostModel:
+    """ Cost of one frame of a method as a function of its number of atoms
+
+        The CPU time follows cpu_coefficient * atoms ** exponent, the peak memory of
+        one ORCA process memory_coefficient * atoms ** 2 MB.
+    """
+
+    def __init__(self, cpu_coefficient, exponent, memory_coefficient=None, runs=0):
+        self.cpu_coefficient = cpu_coefficient
+        self.exponent = exponent
+        self.memory_coefficient = memory_coefficient
+        self.runs = runs
+
+    def cpu_seconds(self, num_atoms):
+        return self.cpu_coefficient * num_atoms ** self.exponent
+
+    def memory_mb(self, num_atoms):
+        return None if self.memory_coefficient is None else self.memory_coefficient * num_atoms ** 2
+
+    def __repr__(self):
+        return (f'CostModel(cpu_coefficient={self.cpu_coefficient:.3g}, exponent={self.exponent:.2f}, '
+                f'memory_coefficient={self.memory_coefficient}, runs={self.runs})')
+
+
+class RunHistory:
+    """ Past ORCA runs of every method, to size the next ones
+
+        Every run records its method, atom count, number of processes, wall and CPU
+        time and peak memory per process in a SQLite file shared by every process
+        of the node. The file is in WAL mode, so it must be on a local filesystem.
+
+        Parameters:
+
+        path(str): path of the SQLite file
+        max_runs(int): number of most recent runs of a method a model is fitted on
+    """
+
+    def __init__(self, path, max_runs=1000):
+        self.path = path
+        self.max_runs = max_runs
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS runs (
+                method TEXT NOT NULL,
+                atoms INTEGER NOT NULL,
+                nprocs INTEGER NOT NULL,
+                wall_time REAL NOT NULL,
+                cpu_time REAL NOT NULL,
+                max_rss_mb REAL,
+                recorded REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS runs_method ON runs (method, recorded);
+        ''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def record(self, method, num_atoms, nprocs, wall_time, cpu_time, max_rss_mb=None):
+        with self._lock:
+            self._connection.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     (method, num_atoms, nprocs, wall_time, cpu_time, max_rss_mb, time.time()))
+
+    def model(self, method, default_exponent=3.0):
+        """ Function to fit the cost model of a method on its most recent runs
+
+            The exponent is fitted in log space when the runs cover several atom
+            counts and kept to default_exponent otherwise (a single trajectory).
+
+            Return:
+
+            CostModel: the fitted model, None when the method never ran
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT atoms, cpu_time, max_rss_mb FROM runs WHERE method = ? AND atoms > 0 AND cpu_time > 0 '
+                'ORDER BY recorded DESC LIMIT ?', (method, self.max_runs)).fetchall()
+        if not rows:
+            return None
+
+        log_atoms = [math.log(atoms) for atoms, _, _ in rows]
+        log_cpu = [math.log(cpu_time) for _, cpu_time, _ in rows]
+        mean_atoms = sum(log_atoms) / len(rows)
+        mean_cpu = sum(log_cpu) / len(rows)
+        variance = sum((x - mean_atoms) ** 2 for x in log_atoms)
+        exponent = default_exponent
+        if variance > 1e-6:
+            slope = sum((x - mean_atoms) * (y - mean_cpu) for x, y in zip(log_atoms, log_cpu)) / variance
+            # Noisy histories over a narrow range of sizes can fit anything, DFT scales between N and N^4
+            exponent = min(max(slope, 1.0), 4.0)
+        cpu_coefficient = math.exp(mean_cpu - exponent * mean_atoms)
+
+        memory = [max_rss_mb / atoms ** 2 for atoms, _, max_rss_mb in rows if max_rss_mb]
+        return CostModel(cpu_coefficient, exponent, max(memory) if memory else None, len(rows))
+
+
+# Function to choose the cores and memory of one ORCA run
+def plan_resources(num_atoms, model, total_cores, memory_mb, atoms_per_core=4, min_core_seconds=60,
+                   default_maxcore=1024, min_maxcore=256, memory_margin=1.25):
+    """ Function to size one ORCA run
+
+        The number of processes grows with the molecule, one per atoms_per_core
+        atoms, and is cut down so that every process gets at least min_core_seconds
+        of work according to the cost model: small molecules do not scale and are
+        better packed side by side. The memory per process comes from the peak
+        memory of the past runs with memory_margin, or default_maxcore without
+        history, and is capped so that one run fits in memory_mb.
+
+        Parameters:
+
+        num_atoms(int): atoms of the frame
+        model(CostModel): cost model of the method, None without history
+        total_cores(int): cores of the node given to ORCA
+        memory_mb(int): memory of the node given to ORCA, in MB
+
+        Return:
+
+        tuple: number of processes, %maxcore in MB and estimated CPU seconds (None without history)
+    """
+    nprocs = max(1, min(total_cores, num_atoms // atoms_per_core))
+    estimate = model.cpu_seconds(num_atoms) if model is not None else None
+    if estimate is not None:
+        nprocs = max(1, min(nprocs, int(estimate // min_core_seconds)))
+
+    peak_memory = model.memory_mb(num_atoms) if model is not None else None
+    maxcore = peak_memory * memory_margin if peak_memory is not None else default_maxcore
+    maxcore = int(max(min(maxcore, memory_mb / nprocs), min_maxcore))
+    return nprocs, maxcore, estimate
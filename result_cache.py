@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+
+# Function to hash a geometry independently of its formatting
+def geometry_hash(xyz_contents, precision=5):
+    """ Function to hash the normalized geometry of one .xyz frame
+
+        The comment line and whitespace are ignored, element symbols are capitalized
+        and coordinates are rounded to precision decimals, so the same frame written
+        by two trajectories gets the same hash.
+
+        Parameters:
+
+        xyz_contents(str): contents of the frame, atom count line first
+        precision(int): number of decimals the coordinates are rounded to
+
+        Return:
+
+        str: hex sha256 of the normalized geometry
+    """
+    lines = xyz_contents.strip().split('\n')
+    num_atoms = int(lines[0])
+    normalized = []
+    for line in lines[2:2 + num_atoms]:
+        fields = line.split()
+        # round() + 0.0 turns -0.0 into 0.0
+        coordinates = ' '.join(f'{round(float(value), precision) + 0.0:.{precision}f}' for value in fields[1:4])
+        normalized.append(f'{fields[0].capitalize()} {coordinates}')
+    return hashlib.sha256('\n'.join(normalized).encode('utf-8')).hexdigest()
+
+
+# Function to hash an ORCA template
+def template_hash(template_contents):
+    return hashlib.sha256(template_contents.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """ Persistent cache of parsed ORCA results keyed by geometry and method template
+
+        Entries live in a SQLite file shared by every process of the node, in WAL
+        mode, so the file must be on a local filesystem: WAL does not work over a
+        network filesystem such as NFS. The cache
+        keeps at most max_entries results and evicts the least recently used ones,
+        and counts its hits and misses. The number of entries is kept in the counters
+        table, and the hits, misses and access times of get are kept in memory and
+        written at the next put or on close, so a lookup never writes to the file.
+
+        Parameters:
+
+        path(str): path of the SQLite file
+        max_entries(int): number of results kept before the least recently used are evicted
+        precision(int): number of decimals the coordinates are rounded to before hashing
+    """
+
+    def __init__(self, path, max_entries=1000000, precision=5):
+        self.path = path
+        self.max_entries = max_entries
+        self.precision = precision
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS results (
+                geometry_hash TEXT NOT NULL,
+                template_hash TEXT NOT NULL,
+                method TEXT NOT NULL,
+                es_energy REAL,
+                gs_energy REAL,
+                run_time REAL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (geometry_hash, template_hash)
+            );
+            CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access);
+            CREATE INDEX IF NOT EXISTS results_method ON results (method);
+            CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0), ('evictions', 0);
+        ''')
+        # Caches created before the entry counter existed are counted once
+        if self._connection.execute("SELECT 1 FROM counters WHERE name = 'entries'").fetchone() is None:
+            self._connection.execute("INSERT OR IGNORE INTO counters SELECT 'entries', COUNT(*) FROM results")
+        self._pending_counts = {'hits': 0, 'misses': 0}
+        self._pending_access = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if any(self._pending_counts.values()) or self._pending_access:
+                self._connection.execute('BEGIN IMMEDIATE')
+                try:
+                    self._flush()
+                    self._connection.execute('COMMIT')
+                except Exception:
+                    self._connection.execute('ROLLBACK')
+                    raise
+        self._connection.close()
+
+    def _increment(self, name, amount=1):
+        self._connection.execute('UPDATE counters SET value = value + ? WHERE name = ?', (amount, name))
+
+    def _flush(self):
+        """ Write the hits, misses and access times kept since the last flush, within the caller's transaction """
+        for name, amount in self._pending_counts.items():
+            if amount:
+                self._increment(name, amount)
+                self._pending_counts[name] = 0
+        if self._pending_access:
+            self._connection.executemany(
+                'UPDATE results SET last_access = ? WHERE geometry_hash = ? AND template_hash = ?',
+                [(accessed,) + key for key, accessed in self._pending_access.items()])
+            self._pending_access.clear()
+
+    def key(self, xyz_contents, template_contents):
+        """ Return the (geometry hash, template hash) key of a frame computed with a template """
+        return geometry_hash(xyz_contents, self.precision), template_hash(template_contents)
+
+    def get(self, key):
+        """ Return the cached result of a key as a dict with es_energy, gs_energy and
+            run_time, or None on a miss """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT es_energy, gs_energy, run_time FROM results WHERE geometry_hash = ? AND template_hash = ?',
+                key).fetchone()
+            if row is None:
+                self._pending_counts['misses'] += 1
+                return None
+            self._pending_access[tuple(key)] = time.time()
+            self._pending_counts['hits'] += 1
+        return {'es_energy': row[0], 'gs_energy': row[1], 'run_time': row[2]}
+
+    def put(self, key, method, es_energy, gs_energy, run_time):
+        """ Store the result of a key and evict the least recently used entries above max_entries """
+        now = time.time()
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._flush()
+                exists = self._connection.execute(
+                    'SELECT 1 FROM results WHERE geometry_hash = ? AND template_hash = ?', tuple(key)).fetchone()
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    tuple(key) + (method, es_energy, gs_energy, run_time, now, now))
+                if exists is None:
+                    self._increment('entries')
+                    entries = self._connection.execute("SELECT value FROM counters WHERE name = 'entries'").fetchone()[0]
+                    if entries > self.max_entries:
+                        evicted = self._connection.execute(
+                            'DELETE FROM results WHERE rowid IN '
+                            '(SELECT rowid FROM results ORDER BY last_access LIMIT ?)', (entries - self.max_entries,)).rowcount
+                        self._increment('entries', -evicted)
+                        self._increment('evictions', evicted)
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+
+    def invalidate(self, method=None):
+        """ Remove the results of one method, or every result when method is None
+
+            Return:
+
+            int: number of removed results
+        """
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                if method is None:
+                    cursor = self._connection.execute('DELETE FROM results')
+                else:
+                    cursor = self._connection.execute('DELETE FROM results WHERE method = ?', (method,))
+                self._increment('entries', -cursor.rowcount)
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+        return cursor.rowcount
+
+    def stats(self):
+        """ Return the hit, miss and eviction counters and the number of entries """
+        with self._lock:
+            stats = dict(self._connection.execute('SELECT name, value FROM counters'))
+            for name, amount in self._pending_counts.items():
+                stats[name] += amount
+        return stats
+
+
+# Main function to inspect or invalidate a cache from the command line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inspect or invalidate the ORCA result cache')
+    parser.add_argument('path', help='path of the cache SQLite file')
+    parser.add_argument('--invalidate', metavar='METHOD', help="remove the results of METHOD, 'all' removes everything")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        sys.exit(f'No cache at {args.path}')
+    with ResultCache(args.path) as cache:
+        if args.invalidate:
+            removed = cache.invalidate(None if args.invalidate == 'all' else args.invalidate)
+            print(f'Removed {removed} results')
+        print(cache.stats())
@@ -2,9 +2,10 @@
 
 from __future__ import absolute_import, unicode_literals
 from celery_app import app
+from celery import chord, group
+from celery.signals import task_prerun, task_postrun, worker_process_shutdown
 import redis
 import os
-import subprocess
 import sys
 import time
 import shutil
@@ -12,214 +13,432 @@ import fcntl
 import glob
 import sentry_sdk
 import re
+import json
+import itertools
 import queue
 import threading
 import tempfile
-from pathlib import Path
+import uuid
 import multiprocessing as mp
 from sentry_sdk import capture_exception
 from os.path import splitext, basename
-from contextlib import contextmanager
-
-
-geo_path = '/home/vsaintloui/valmy/geometries/'
-energy_path='/home/vsaintloui/valmy/energies/'
-gs_energy_path ='/home/vsaintloui/valmy/gs_energies/'
-run_time_path = '/home/vsaintloui/valmy/gs_energies/'
+from contextlib import nullcontext
+from trajectory import XYZTrajectory, count_frames, find_trajectory_files
+from orca_runner import OrcaChain, OrcaJob, make_chains, run_chain, run_jobs, run_orca, scf_signature, template_nprocs
+from resource_planner import RunHistory, apply_resources, available_memory_mb, plan_resources
+from result_cache import ResultCache, template_hash
+from manifest import DONE, QUARANTINED, FrameManifest, manifest_key
+from progress import EventProgress
+from orca_parser import parse_orca_log
+from property_store import export_tsv, write_properties
+from publish import publish_outputs
+from data_acquisition import checkout_commit, configure_shared_cache, pull_dvc_targets
+from locks import DistributedLock, LockContended, repository_lock_name
+from workspace import JobWorkspace, scratch_root
+from frame_selection import load_selection_config, select_frames
+import metrics
+from metrics import Metrics, remove_prometheus_textfile, write_event_report, write_prometheus_textfile
+
+
+# Root of the per-job scratch workspaces, on tmpfs (/dev/shm) instead when use_tmpfs_scratch is set
+scratch_path = '/home/vsaintloui/valmy/scratch/'
+use_tmpfs_scratch = False
 orca_path= '/opt/orca_5_0_3_linux_x86-64_openmpi411/orca'
-lock_file = open('/home/vsaintloui/valmy/repo/script/separate-file.lock', 'w')
-output_repo= '/home/vsaintloui/valmy/workrepo/molecule_repo/benzene/cmd/properties/'
-geo_path_repo ='/home/vsaintloui/valmy/workrepo/molecule_repo/benzene/cmd/geometries/'
+# Number of cores the concurrent ORCA runs of one worker may use together
+orca_core_budget = mp.cpu_count()
+# Size every ORCA run from the atom count of its frame and the past runs of its method: the %pal nprocs and
+# %maxcore chosen are written into the input and the runs are packed on the cores and memory of the node.
+# Without it every run takes the %pal nprocs of its template. The run history is one per node, on local storage
+# like result_cache_path.
+adaptive_resources = True
+run_history_path = '/var/tmp/valmy/cache/orca_run_history.sqlite'
+# Share of the available memory of the node the concurrent ORCA runs may use together
+orca_memory_fraction = 0.8
+atoms_per_core = 4
+# An ORCA run is killed after orca_timeout_factor times its estimated run time, at least orca_min_frame_timeout
+# and at most orca_frame_timeout seconds (the limit without history). A frame failing frame_max_attempts
+# times is quarantined and reported. Done frames are kept in a per-event manifest in Redis for manifest_ttl
+# seconds, so a retried task only computes the frames that are not done.
+orca_frame_timeout = 12 * 3600
+orca_min_frame_timeout = 600
+orca_timeout_factor = 5
+frame_max_attempts = 3
+manifest_ttl = 7 * 24 * 3600
+# A compute subtask failing (Redis, filesystem, worker error) is retried up to compute_max_retries times,
+# compute_retry_delay seconds later and twice as late at every retry, resuming from the manifests
+compute_max_retries = 3
+compute_retry_delay = 300
+# Shortest time in seconds between two updates of the Celery state of a compute task and of its event
+progress_interval = 10
+# Number of frames computed by one Celery subtask. None sizes the chunks so that a subtask runs about
+# runs_per_core_per_task ORCA runs per core of orca_core_budget, so large trajectories spread over every
+# compute worker. A subtask must finish within the visibility_timeout of celery_app.py (48 h), or Redis
+# hands it to another worker while it still runs: with hung frames it can take up to about
+# runs_per_core_per_task * frame_max_attempts * orca_frame_timeout.
+frames_per_task = None
+runs_per_core_per_task = 4
+# Persistent cache of parsed ORCA results, keyed by geometry rounded to geometry_precision decimals and template.
+# It is one per node: SQLite in WAL mode needs a local filesystem, not a network one like /home.
+result_cache_path = '/var/tmp/valmy/cache/orca_results.sqlite'
+result_cache_max_entries = 1000000
+geometry_precision = 5
+# Chain consecutive frames so each ORCA run starts its SCF from the previous frame's orbitals (MORead)
+warm_start = False
+# Compute every method of a trajectory chunk in one subtask, on geometries separated once, instead of one
+# subtask per (trajectory, method). With share_scf the methods whose templates only differ after the SCF
+# (see orca_runner.scf_signature) start each frame from the orbitals converged by the first of them.
+multi_method_tasks = True
+share_scf = True
+# Also export the results in the former text layout next to the columnar .npy store
+export_tsv_properties = True
+# Locks expire lock_ttl seconds after their owner stopped renewing them. A task finding its lock
+# taken is requeued for lock_requeue_delay seconds ('requeue') or waits for it ('wait').
+lock_ttl = 300
+lock_contention_policy = 'requeue'
+lock_requeue_delay = 60
+lock_max_requeues = 1000
+lock_wait_timeout = None
+# Frame subsampling per repository, a JSON object mapping repository names (or '*') to a selection
+# such as {"stride": 2, "count": 500, "strategy": "rmsd"}. A push can pass its own to run_script.
+frame_selection_config = '/home/vsaintloui/valmy/frame_selection.json'
+# Textfile collector directory of the node exporter, the worker processes export their stage metrics there
+metrics_textfile_directory = '/home/vsaintloui/valmy/metrics/'
+# ORCA templates, one file per method, and clones of the data repositories
+template_path = '/home/vsaintloui/valmy/template/'
+workrepo_path = '/home/vsaintloui/valmy/workrepo/'
+# DVC cache shared by every event of a repository (one directory per repository) and parallel downloads of dvc pull
+dvc_cache_path = '/home/vsaintloui/valmy/dvc-cache/'
+dvc_pull_jobs = 16
+# Outputs of the events between their aggregation and their publication, on a filesystem shared with the publish workers
+staging_path = '/home/vsaintloui/valmy/staging/'
+# Trajectories and outputs inside the clone of a repository, see repository_paths
+geometries_subdirectory = 'benzene/cmd/geometries/'
+properties_subdirectory = 'benzene/cmd/properties/'
 sentry_sdk.init('https://34bf612982af41c89dde38029a16861e@o4505107939393536.ingest.sentry.io/4505107943653376')
 
 
 # Function to separate file into individual molecule strings
-def separate_trajectory(input_file, output_directory, prefix):
+def separate_trajectory(input_file, output_directory, prefix, start=0, stop=None, frames=None):
     """ Function to separate file into individual molecule strings
-    
+
+        Frames are streamed from a memory-mapped trajectory through its cached frame
+        index, so only the requested frames are read. When input_file is a directory
+        every .xyz file inside it is separated and the numbering continues across files.
+
         Parameters:
 
-        input_file (str): path of the trajectory file
+        input_file (str): path of the trajectory file or of a directory of trajectories
         output_directory(str): path of saved geometries files from trajectory
         prefix(str): name of the file here it's 'geometry'
-    
-    """
-
-    # check if path is a file
-    isFile = os.path.isfile(input_file)
-    print(isFile)
-
-    if isFile:
-        with open(input_file,'r') as f:
-            contents =f.read()
-    else:
-        files=list(Path(input_file).rglob('*.xyz'))
-        if not files:
-            print("No .xyz files found in the specified directory")
-        else:
-            file_path=files[0].as_posix()
-            with open(file_path,'r') as f:
-                contents =f.read()
-
+        start(int): first frame to write (0-based)
+        stop(int): frame to stop before, None writes up to the last frame
+        frames(list): frames to write (0-based), replaces start and stop when given
 
-    # Split the contents into individual lines
-    lines = contents.strip().split('\n')
+        Return:
 
-    # Initialize an empty list to hold the individual molecule strings
-    molecules = []
-
-    for i, line in enumerate(lines):
-        if not line.strip().isdigit():
-            continue
+        list: paths of the written geometry files
+    """
 
-        num_atoms = int(line)
-        molecule_str = '\n'.join(lines[i:i + num_atoms + 2]) + '\n'
-        molecules.append(molecule_str)
+    files = find_trajectory_files(input_file)
+    if not files:
+        print("No .xyz files found in the specified directory")
+        return []
 
     # Create the output directory if it doesn't already exist
     os.makedirs(output_directory, exist_ok=True)
 
-    # Loop over each molecule and write it to a separate file in the output directory
-    for i, molecule in enumerate(molecules):
-        # Construct the output file name for the current molecule
-        output_file = os.path.join(output_directory, f'{prefix}_{i+1}.xyz')
-
-        # Write the current molecule to the output file
-        with open(output_file, 'w') as f:
-            f.write(molecule)
-
-# Function to calculate energy
-def calculate_energy(input_file, output_directory, file_name, energy_calculation_method):
-    """ Function to calculate excited energy and ground state energy
+    written_files = []
+    first_frame = 0
+    for file_path in files:
+        with XYZTrajectory(file_path) as trajectory:
+            num_frames = len(trajectory)
+            if frames is not None:
+                local_frames = [frame - first_frame for frame in frames if first_frame <= frame < first_frame + num_frames]
+            else:
+                local_stop = num_frames if stop is None else min(stop - first_frame, num_frames)
+                local_frames = range(max(start - first_frame, 0), local_stop)
+
+            # Loop over each molecule and write it to a separate file in the output directory
+            for i in local_frames:
+                output_file = os.path.join(output_directory, f'{prefix}_{first_frame + i + 1}.xyz')
+                with open(output_file, 'w') as f:
+                    f.write(trajectory.frame(i))
+                written_files.append(output_file)
+        first_frame += num_frames
+
+    return written_files
+
+# Function to sort geometry files by frame number instead of alphabetically
+def frame_number(filename):
+    """ Return the frame number of 'geometry_N.xyz', so geometry_10 comes after geometry_9 """
+    match = re.search(r'(\d+)\D*$', filename)
+    return int(match.group(1)) if match else -1
+
+# Function to calculate the energies of every geometry with several methods at once
+def calculate_energies(input_file, output_directory, file_name, energy_calculation_methods, frames=None, on_record=None):
+    """ Function to calculate the excited and ground state energies of the
+        geometries of a directory with several methods in one pass
 
         Adapt Phd Student's code originally written in Shell of 
         Holzenkamp Matthias at Constructor University to Python language
 
+        Every geometry is read once and the ORCA runs of all (frame, method) pairs
+        are executed concurrently within the orca_core_budget of the node. With
+        adaptive_resources every run gets the '%pal nprocs' and '%maxcore' planned
+        from the atom count of its frame and the past runs of its method (see
+        resource_planner.plan_resources) and the runs are packed on the cores and
+        orca_memory_fraction of the available memory; otherwise each one takes the
+        '%pal nprocs' of its template.
+        Geometries found in the result cache for a template skip ORCA entirely.
+        With share_scf, the methods whose templates have the same scf_signature run
+        one after the other on a frame, every one after the first reading the
+        converged orbitals of the one before it (MORead). With warm_start, contiguous
+        blocks of frames are chained and every frame of a block reads its initial
+        guess from the orbitals of the frame before it.
+
         Parameters:
 
         input_file(str): path of saved geometries files from trajectory
-        output_directory(str): path of files generated after calculating  energy
+        output_directory(str): path of files generated after calculating energy, one directory per method
         file_name(str): name of the current trajectory processing
-        energy_calculation_method(str): name of the computational chemistry method to run Orca
-    
+        energy_calculation_methods(list): names of the methods to run Orca with
+        frames(dict): frames (0-based) to compute for each method, every geometry when None
+        on_record(callable): called with the method and the record of every frame as soon as it is known
+
+        Return:
+
+        dict: per method, one dict per frame in frame order with the frame index
+              (0-based), es_energy and gs_energy in eV and run_time in minutes, plus
+              scf_iterations, warm_start, shared_scf, the [energy, oscillator strength]
+              of every excited state, complete and the error of a failed run for
+              computed frames
     """
     input_file_str = str(input_file)
-    # Create the output directory if it doesn't already exist
-    os.makedirs(output_directory, exist_ok=True)
-    os.makedirs(gs_energy_path, exist_ok =True)
-    os.chdir(output_directory)
-    file_basename = splitext(basename(file_name))[0]
     
-    with open(f'/home/vsaintloui/valmy/template/{energy_calculation_method}') as orca_template:
-        template_contents = orca_template.read()
-
-
-    for filename in sorted(os.listdir(input_file_str)):
-        if filename.endswith('.xyz'):
+    templates = {}
+    for energy_calculation_method in energy_calculation_methods:
+        with open(os.path.join(template_path, energy_calculation_method)) as orca_template:
+            templates[energy_calculation_method] = orca_template.read()
+        # Create the output directory if it doesn't already exist
+        os.makedirs(os.path.join(output_directory, energy_calculation_method), exist_ok=True)
+
+    jobs = []
+    records = {energy_calculation_method: {} for energy_calculation_method in energy_calculation_methods}
+    cache_keys = {}
+    atom_counts = {}
+    # The run history only sizes the runs with adaptive_resources, it is not touched otherwise
+    with ResultCache(result_cache_path, result_cache_max_entries, geometry_precision) as cache, \
+            (RunHistory(run_history_path) if adaptive_resources else nullcontext()) as history:
+        memory_budget = None
+        models = {}
+        if adaptive_resources:
+            memory_budget = int(available_memory_mb() * orca_memory_fraction)
+            for energy_calculation_method in energy_calculation_methods:
+                models[energy_calculation_method] = history.model(energy_calculation_method)
+                print(f'Sizing the {energy_calculation_method} runs with {models[energy_calculation_method]} '
+                      f'within {orca_core_budget} cores and {memory_budget} MB')
+        geometry_files = [filename for filename in os.listdir(input_file_str) if filename.endswith('.xyz')]
+        for filename in sorted(geometry_files, key=frame_number):
             filepath = input_file_str + '/' + filename
-            input_filename = splitext(filename)[0] + '.inp'
-            
-            # Create orca input file
-            input_contents = template_contents + f'\n *xyzfile 0 1 {filepath}\n'
-            with open(input_filename, 'w') as input_file:
-                input_file.write(input_contents)
-
-            # Run orca on input file
-            log_filename = splitext(filename)[0] + '.log'
-            orca_command = f"{orca_path} {input_filename} > {log_filename}"
-            try:
-                subprocess.run(orca_command, shell=True, check=True)
-            except subprocess.CalledProcessError as e:
-                print(f"Error running Orca command: {e.cmd}")
-                print(f"Return code: {e.returncode}")
-                print(f"Output: {e.output}")
-                print(f"Error output: {e.stderr}")
-
-            energy_filename = os.path.join(energy_path, energy_calculation_method + '.dat')
-            gs_energy_filename = os.path.join(gs_energy_path, energy_calculation_method + '.dat')
-                
-
-            energy_data = []
-            gs_energy_data = []
-
-            with open(log_filename) as log_file:
-                found_lowest_energy = found_e_scf = False
-                for line in log_file:
-                    if not found_lowest_energy and 'Lowest Energy' in line:
-                        energy = line.split()[3]
-                        float_energy = float(energy) * 27.211386245988
-                        energy_data.append(str(float_energy))
-                        found_lowest_energy = True
-                        
-                    if not found_e_scf and "E(SCF)" in line:
-                        gs_energy_value = line.split()[2]
-                        float_gs_energy = float(gs_energy_value) * 27.211386245988
-                        gs_energy_data.append(str(float_gs_energy))
-                        found_e_scf = True
-
-                    if found_lowest_energy and found_e_scf:
-                        break
-
-            with open(energy_filename, 'a') as energy_file, \
-                    open(gs_energy_filename, 'a') as gs_energy_file:
-                    energy_file.write('\n'.join(energy_data) + '\n')
-                    gs_energy_file.write('\n'.join(gs_energy_data) + '\n')
-
-            extract_run_time(file_basename, log_filename, energy_calculation_method)
+            frame = frame_number(filename) - 1
+            with open(filepath) as geometry_file:
+                geometry_contents = geometry_file.read()
+            atom_counts[frame] = int(geometry_contents.split('\n', 1)[0])
+
+            for energy_calculation_method in energy_calculation_methods:
+                if frames is not None and frame not in frames[energy_calculation_method]:
+                    continue
+                template_contents = templates[energy_calculation_method]
+
+                # Skip ORCA entirely when this geometry was already computed with this template
+                cache_key = cache.key(geometry_contents, template_contents)
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    records[energy_calculation_method][frame] = dict(cached, frame=frame)
+                    if on_record is not None:
+                        on_record(energy_calculation_method, records[energy_calculation_method][frame])
+                    continue
+
+                input_filename = os.path.join(output_directory, energy_calculation_method, splitext(filename)[0] + '.inp')
+
+                log_filename = os.path.join(output_directory, energy_calculation_method, splitext(filename)[0] + '.log')
+                if adaptive_resources:
+                    job_nprocs, maxcore, estimate = plan_resources(atom_counts[frame], models[energy_calculation_method],
+                                                                   orca_core_budget, memory_budget, atoms_per_core)
+                    input_contents = apply_resources(template_contents, job_nprocs, maxcore)
+                    timeout = orca_frame_timeout
+                    if estimate is not None:
+                        timeout = min(max(orca_timeout_factor * estimate / job_nprocs, orca_min_frame_timeout), orca_frame_timeout)
+                    job = OrcaJob(frame, input_filename, log_filename, job_nprocs, job_nprocs * maxcore,
+                                  estimate if estimate is not None else atom_counts[frame] ** 3, timeout,
+                                  energy_calculation_method)
+                else:
+                    input_contents = template_contents
+                    job = OrcaJob(frame, input_filename, log_filename, template_nprocs(template_contents),
+                                  timeout=orca_frame_timeout, method=energy_calculation_method)
+
+                # Create orca input file
+                with open(input_filename, 'w') as input_file:
+                    input_file.write(input_contents + f'\n *xyzfile 0 1 {filepath}\n')
+                jobs.append(job)
+                cache_keys[job] = cache_key
+
+        num_cached = sum(len(method_records) for method_records in records.values())
+        print(f"{num_cached} runs found in the result cache, {len(jobs)} to compute with {', '.join(energy_calculation_methods)}")
+        metrics.increment('frames_cached', num_cached)
+        metrics.increment('frames_computed', len(jobs))
+
+        # The jobs of the methods converging the same SCF, in frame order and within a frame in method order
+        scf_groups = {}
+        for job in jobs:
+            group_key = scf_signature(templates[job.method]) if share_scf else job.method
+            scf_groups.setdefault(group_key, []).append(job)
+        # Jobs starting from the orbitals of another method on the same frame
+        shared = set()
+        for group_jobs in scf_groups.values():
+            shared.update(job for previous_job, job in zip(group_jobs, group_jobs[1:]) if previous_job.frame == job.frame)
+
+        # Every log is parsed as soon as its run is done, so its frame is reported while the others still run.
+        # Chains call it from their own threads, everything it touches is thread-safe.
+        def finish(job, warm):
+            with metrics.stage('log_parsing'):
+                result = parse_orca_log(job.log_path)
+            error = None
+            if job.timed_out:
+                error = f'killed after {job.timeout:.0f} seconds'
+            elif not result.complete:
+                error = 'ORCA did not terminate normally' if not result.terminated_normally else 'incomplete ORCA output'
+            if error is not None:
+                print(f'{error} for {job.log_path}')
+            if job.wall_time is not None:
+                metrics.observe('orca_frame_wall', job.wall_time)
+                metrics.observe('orca_frame_cpu', job.cpu_time)
+            record = {
+                'frame': job.frame,
+                'es_energy': result.es_energy,
+                'gs_energy': result.scf_energy,
+                'run_time': result.run_time,
+                'scf_iterations': result.scf_iterations,
+                'warm_start': warm and job not in shared,
+                'shared_scf': warm and job in shared,
+                'excited_states': [[state.energy, state.oscillator_strength] for state in result.excited_states],
+                'orca_wall_time': job.wall_time,
+                'orca_cpu_time': job.cpu_time,
+                'complete': result.complete and not job.timed_out,
+                'error': error,
+            }
+            records[job.method][job.frame] = record
+            # Failed runs are not cached so they are retried next time, nor used to size the next runs
+            if record['complete']:
+                if history is not None and job.wall_time is not None:
+                    history.record(job.method, atom_counts[job.frame], job.nprocs, job.wall_time,
+                                   job.cpu_time, job.max_rss_mb)
+                cache.put(cache_keys[job], job.method, result.es_energy, result.scf_energy, result.run_time)
+                if record['shared_scf']:
+                    metrics.increment('frames_shared_scf')
+            else:
+                metrics.increment('frames_failed')
+            if on_record is not None:
+                on_record(job.method, record)
+
+        with metrics.stage('orca'):
+            if warm_start:
+                # Contiguous blocks of frames run side by side, each frame of a block starting from the previous one's orbitals
+                chains = [chain for group_jobs in scf_groups.values()
+                          for chain in make_chains(group_jobs, orca_core_budget, key=lambda job: job.frame)]
+            elif shared:
+                # The methods sharing an SCF run one after the other on each frame, the frames side by side
+                chains = [OrcaChain(list(frame_jobs)) for group_jobs in scf_groups.values()
+                          for _, frame_jobs in itertools.groupby(group_jobs, key=lambda job: job.frame)]
+            else:
+                chains = None
+            if chains is not None:
+                run_jobs(chains, lambda chain: run_chain(orca_path, chain, on_job=finish), total_cores=orca_core_budget,
+                         total_memory=memory_budget)
+            else:
+                # Run orca on every input file, as many at once as the core budget allows
+                run_jobs(jobs, lambda job: run_orca(orca_path, job), total_cores=orca_core_budget,
+                         total_memory=memory_budget, on_done=lambda job, _: finish(job, False))
+
+    results = {}
+    for energy_calculation_method, method_records in records.items():
+        results[energy_calculation_method] = [method_records[frame] for frame in sorted(method_records)]
+        if warm_start:
+            report_warm_start(results[energy_calculation_method], energy_calculation_method)
+    if shared:
+        print(f'{len(shared)} runs started from the SCF of another method on the same frame')
+    return results
+
+
+# Function to compare the warm started ORCA runs with the cold started ones
+def report_warm_start(records, energy_calculation_method):
+    """ Function to print the SCF iterations and run time of the warm started frames
+        against the cold started ones (the first frame of every chain), and the time
+        saved by the warm start
+
+        Return:
+
+        dict: number of frames, mean SCF iterations and mean run time of both kinds,
+              and the estimated minutes saved
+    """
+    def summarize(selected):
+        iterations = [record['scf_iterations'] for record in selected if record.get('scf_iterations') is not None]
+        run_times = [record['run_time'] for record in selected if record.get('run_time') is not None]
+        return {
+            'frames': len(selected),
+            'mean_scf_iterations': sum(iterations) / len(iterations) if iterations else None,
+            'mean_run_time': sum(run_times) / len(run_times) if run_times else None,
+        }
+
+    # Frames started from another method's SCF are neither warm nor cold started
+    computed = [record for record in records if 'warm_start' in record and not record.get('shared_scf')]
+    cold = summarize([record for record in computed if not record['warm_start']])
+    warm = summarize([record for record in computed if record['warm_start']])
+    saved = None
+    if cold['mean_run_time'] is not None and warm['mean_run_time'] is not None:
+        saved = (cold['mean_run_time'] - warm['mean_run_time']) * warm['frames']
+
+    print(f"Warm start with {energy_calculation_method}: "
+          f"cold {cold['frames']} frames, {cold['mean_scf_iterations']} SCF cycles, {cold['mean_run_time']} min on average; "
+          f"warm {warm['frames']} frames, {warm['mean_scf_iterations']} SCF cycles, {warm['mean_run_time']} min on average; "
+          f"about {saved} min saved")
+    return {'method': energy_calculation_method, 'cold': cold, 'warm': warm, 'minutes_saved': saved}
 
             
-# Function to extract run time to calculate the energy
-def extract_run_time(filename,log_file_path, energy_calculation_method):
-
-    data_file_path = os.path.join(output_repo,filename,'run_time',f'{energy_calculation_method}.dat')
-    dir_path = os.path.dirname(data_file_path)
-    os.makedirs(dir_path, exist_ok = True)
-
-    run_time_pattern =  re.compile(r"TOTAL RUN TIME:\s+\d+ days\s+(\d+) hours\s+(\d+) minutes\s+(\d+) seconds\s+(\d+) msec")
-
-    with open(log_file_path, 'r') as log_file:
-         for line in log_file:
-            match = run_time_pattern.search(line)
-            if match:
-                hours, minutes, seconds, mseconds = match.groups()
-                total_seconds = float(hours) * 3600 + float(minutes) * 60 + float(seconds) + float(mseconds)/1000
-                total_seconds=total_seconds/60
-                break
-    with open(data_file_path, 'a') as data_file:
-            data_file.write(f'{total_seconds:.6f}\n')
-
-# Function to prepend energy 
-def prepend_data(filename, data_type, energy_calculation_method):
-    data_type_map = {
-        "energy": (energy_path, "es_energies"),
-        "gs_energy": (gs_energy_path, "gs_energies")
-    }
-
-    if data_type not in data_type_map:
-        raise ValueError(f"Invalid data_type: {data_type}")
-
-    input_path, subdir = data_type_map[data_type]
-    input_file = f"{input_path}/{energy_calculation_method}.dat"
+# Function to write the energies and run times of a trajectory to the output repository
+def write_energy_data(output_directory, filename, energy_calculation_method, records):
+    """ Function to write the per-frame results of one trajectory and one method
 
-    file_basename = splitext(basename(filename))[0]
-    output_file = f"{output_repo}/{file_basename}/{subdir}/{energy_calculation_method}.dat"
+        The results go to a columnar store of typed .npy arrays (frame, es_energy,
+        gs_energy, run_time) under '<trajectory>/arrays/<method>/'. With
+        export_tsv_properties the text files of the former layout are exported
+        from it as well: the energy files with the frame index as first column and
+        the run time file with one line per frame in minutes.
+
+        Parameters:
 
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        output_directory(str): properties directory of the data repository
+        filename(str): name of the trajectory
+        energy_calculation_method(str): name of the method the energies were computed with
+        records(list): one dict per frame with frame, es_energy, gs_energy and run_time
 
-    with open(input_file, 'r') as f_in, open(output_file, 'w') as f_out:
-        for i, line in enumerate(f_in):
-            row = line.rstrip('\n').split('\t')
-            row.insert(0, str(i))
-            f_out.write('\t'.join(row) + '\n')
-    shutil.move(output_file, input_file)
-    shutil.move(input_file, output_file)
+        Return:
 
-# Function to remove specific files generated by Orca
-def remove_extension():
-    # Remove all files with the specified extensions
-    for ext in ['xyz', 'dvc', 'gbw', 'cis', 'prop', 'txt']:
-        for file in glob.glob(f'*.{ext}'):
-            os.remove(file)
+        list: paths to add to DVC, the store directory and the exported text files
+    """
+    file_basename = splitext(basename(filename))[0]
+    store_directory = f"{output_directory}/{file_basename}/arrays/{energy_calculation_method}"
+    write_properties(store_directory, records)
+    output_files = [store_directory]
+
+    if export_tsv_properties:
+        output_files += export_tsv(
+            store_directory,
+            f"{output_directory}/{file_basename}/es_energies/{energy_calculation_method}.dat",
+            f"{output_directory}/{file_basename}/gs_energies/{energy_calculation_method}.dat",
+            f"{output_directory}/{file_basename}/run_time/{energy_calculation_method}.dat",
+        )
+    return output_files
 
 # Function to delete files in geometries folder
 def delete_contents_geometries(directory_path, extensions, basenames):
@@ -246,128 +465,58 @@ def delete_contents_geometries(directory_path, extensions, basenames):
 
 
 
-# Function to delete properties folder
-def delete_contents_properties(directory_path):
-    try:
-        if not os.path.isdir(directory_path):
-            raise Exception(f"The directory {directory_path} does not exist or is not a directory")
-        
-        for item in os.listdir(directory_path):
-            item_path = os.path.join(directory_path, item)
-            if os.path.isfile(item_path):
-                os.unlink(item_path)
-            elif os.path.isdir(item_path):
-                shutil.rmtree(item_path)
-    except Exception as e:
-        raise Exception(f'Failed to delete contents of {directory_path}. Reason: {e}')
-        
-# Function to delete properties and geometries
-def delete_local_files(directory_path, directory_to_delete_path, extensions,basenames):
-    delete_contents_geometries(directory_path, extensions, basenames)
-    delete_contents_properties(directory_to_delete_path)
-
-  # Function to push using git
-def git_push(remote, branch_name):
-    try:
-        output = subprocess.check_output(['git', 'push', remote, branch_name], stderr=subprocess.STDOUT)
-        print("Push succeeded.")
-    except subprocess.CalledProcessError as e:
-        output = e.output.decode('utf-8')
-        if "failed to update ref" in output:
-            print("Push failed. Pulling latest changes from remote repository.")
-            subprocess.call(['git', 'pull', remote, branch_name, '--no-edit'])
-            print("Retrying push.")
-            git_push(remote, branch_name)
-        if "failed to push" in output:
-            subprocess.call(['git', 'pull', remote, branch_name, '--no-edit']) # Skip interactive editor and enter a generic merging commit statement
-            print("Retrying push.")
-            git_push(remote, branch_name)
-  
-            
-# Function to push data to Gitea repostiroy and Azure cloud storage
-def push_data_to_repo(directory,filename, energy_calculation_method, branch_name):
-#     os.chdir('/home/vsaintloui/valmy/workrepo/molecule_repo')
-    os.chdir(directory)
-    remote = subprocess.check_output(['git', 'remote']).decode('utf-8').strip()
-
-    # Remove the file extension and only keep the filename
-    file_basename = splitext(basename(filename))[0]
-
-    output_file = f"{output_repo}/{file_basename}/es_energies/{energy_calculation_method}.dat"
-    output_file_gs = f"{output_repo}/{file_basename}/gs_energies/{energy_calculation_method}.dat"
-    output_file_run_time = f"{output_repo}/{file_basename}/run_time/{energy_calculation_method}.dat"
-
-    # Run the 'dvc add' command
-    add_data=subprocess.check_output(['dvc', 'add', output_file, output_file_gs, output_file_run_time], universal_newlines=True)
-    print('newline :', add_data)
-    # Run the 'git commit' command
-    commit= subprocess.check_output(['git', 'commit', '-m', 'adding new data'], universal_newlines=True)
-    print('output :', commit)
-    git_push(remote, branch_name)
-
-geo_path_repo ='/home/vsaintloui/valmy/workrepo/molecule_repo/benzene/cmd/geometries/'
-
-
-def clear_cache_and_fetch_data():
-#     subprocess.run(['dvc', 'gc', '-c'], check=True)
-    subprocess.run(['dvc', 'fetch', '-a', '-T'], check=True)
-
-
-def run_git_checkout(branch_name):
-
-    """ Function to checkout the current branch, in case if fail, fetch the data 
-
-        Parameter : 
-        
-        branch_name (str)
-
-    """
-    try:
-        subprocess.run(['git', 'checkout', branch_name], check=True)
-    except subprocess.CalledProcessError as e:
-            print(f'Error during git checkout: {e}')
-
-            try:
-                clear_cache_and_fetch_data()
-                # Attempt git checkout again after clearing cache and fetching data
-                subprocess.run(['git', 'checkout', branch_name], check=True)
-            except Exception as e:
-                print(f'Error during cache clearing and data fetching: {e}')
-                capture_exception(e)
-        
-# Function to get the last files committed using dvc pull
-def get_last_dvc_pulled_files(directory, branch_name, list_dvc_file_names):
+# Function to delete the outputs published by an event
+def delete_published_outputs(output_files):
+    """ Function to delete the published files and directories of an event from the
+        working tree, their data stays in the DVC cache and remote. Outputs of
+        other events in the same directories are left alone. """
+    for path in output_files:
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+        except Exception as e:
+            print(f"Failed to delete {path}. Reason: {str(e)}")
+
+
+# Function to locate the clone of a repository and its trajectories and outputs
+def repository_paths(repo_name):
+    """ Return the clone of the repository under workrepo_path, its geometries
+        directory and its properties directory. Every branch of a repository
+        shares the clone, so all three are guarded by repository_lock_name(repo_name). """
+    clone_directory = os.path.join(workrepo_path, repo_name)
+    return (clone_directory, os.path.join(clone_directory, geometries_subdirectory),
+            os.path.join(clone_directory, properties_subdirectory))
+
+# Function to get the trajectories added by a push
+def get_last_dvc_pulled_files(directory, branch_name, list_dvc_file_names, commit_sha=None):
     
-    """ Function to get the last files that was committed using DVC
+    """ Function to check out the pushed commit in the warm clone of the repository
+        and pull the data of the added .dvc files
     
         Parameters :
         
-        directory (str): 
-        branch_name(str):
-        list_dvc_file_names(list):
+        directory (str): path of the clone of the repository, kept between events
+        branch_name(str): branch that was pushed
+        list_dvc_file_names(list): names of the .xyz.dvc files added by the push
+        commit_sha(str): commit of the push, the tip of the branch when None
         
         Return :
         
-        list: 
+        list: paths of the pulled .xyz files
     """
-    os.chdir(directory)
-    
-    git_pull_result=subprocess.run(['git', 'pull', 'origin', 'main'], check=True, stdout=subprocess.PIPE)  
-    print(git_pull_result.stdout.decode('utf-8'))
-    cmd = ['dvc', 'pull'] + [geo_path_repo + ele for ele in list_dvc_file_names]
-
-    result = subprocess.check_output(cmd, universal_newlines=True)
-    print(result)
-    run_git_checkout(branch_name) 
-    lines = result.split('\n')
-    file_lines = [line for line in lines if line.startswith('A       ')]
-    files = [line.split('A       ')[1] for line in file_lines]
+    with metrics.stage('git_fetch'):
+        checkout_commit(directory, branch_name, commit_sha)
+    with metrics.stage('dvc_pull'):
+        configure_shared_cache(directory, os.path.join(dvc_cache_path, basename(os.path.normpath(directory))))
+        outputs = pull_dvc_targets(directory, [os.path.join(directory, geometries_subdirectory, ele)
+                                               for ele in list_dvc_file_names], dvc_pull_jobs)
     xyz_files = []
-    for file in files:
-        file_path = os.path.join(directory, file)
+    for file_path in outputs:
         if os.path.isdir(file_path):
             xyz_files.extend(get_xyz_files_from_folder(file_path))
-        elif file.endswith('.xyz'):
+        elif file_path.endswith('.xyz'):
             xyz_files.append(file_path)
     return xyz_files
 
@@ -381,94 +530,606 @@ def get_xyz_files_from_folder(folder_path):
                 xyz_files.append(os.path.join(root, file))
     return xyz_files
 
+# Function to give an event its own links to the trajectories it processes
+def stage_trajectories(file_paths, source_directory, prefix):
+    """ Function to hardlink the pulled trajectories of an event into a directory of
+        its own under staging_path, copying them when the clone is on another
+        filesystem. The clone is shared by the events of the repository: publishing
+        an event deletes the trajectories from it while other events still split and
+        compute theirs, each from its own links.
+
+        Parameters:
+
+        file_paths(list): paths of the trajectories in the clone
+        source_directory(str): directory of the clone the paths are kept relative to
+        prefix(str): prefix of the name of the staging directory
+
+        Return:
+
+        tuple: staging directory, paths of the staged trajectories
+    """
+    os.makedirs(staging_path, exist_ok=True)
+    staging_directory = tempfile.mkdtemp(prefix=f'{prefix}_trajectories_', dir=staging_path)
+    staged_paths = []
+    for file_path in file_paths:
+        staged_path = os.path.join(staging_directory, os.path.relpath(file_path, source_directory))
+        os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+        try:
+            os.link(file_path, staged_path)
+        except OSError:
+            shutil.copy2(file_path, staged_path)
+        staged_paths.append(staged_path)
+    return staging_directory, staged_paths
+
+
+# Function to split the frames of a trajectory into the chunks handled by one subtask each
+def frame_chunks(file_path, frames=None, num_methods=1):
+    """ Return the frame lists of the subtasks of a trajectory, of frames_per_task
+        frames each, or of runs_per_core_per_task ORCA runs per core of the budget
+        when it is None, given the num_methods methods a subtask runs on every frame """
+    chunk_size = frames_per_task or max(orca_core_budget * runs_per_core_per_task // max(num_methods, 1), 1)
+    if frames is None:
+        frames = list(range(count_frames(file_path)))
+    return [frames[start:start + chunk_size] for start in range(0, len(frames), chunk_size)]
+
+# Function to send a progress update without letting its failure reach the computation
+def report_safely(description, function, *args, **kwargs):
+    """ Call function(*args, **kwargs) and return its result, or None after logging
+        when it fails: a Redis or result backend hiccup costs one progress update,
+        never the frames being computed or published """
+    try:
+        return function(*args, **kwargs)
+    except Exception as e:
+        print(f'Failed to {description}. Reason: {e}')
+        return None
+
+
 # Function to call all other functions
-def process_file(directory, filename, energy_calculation_method,branch_name):
-    file_basename = basename(filename)
-    print(f'\nProcessing file: {file_basename}')
+def process_trajectory(directory, filename, energy_calculation_methods, frames=None, event_id=None, on_progress=None):
+    """ Function to compute the energies of some frames of one trajectory with
+        several methods, in a scratch workspace of its own
+
+        The frames are separated once and the runs of every (frame, method) pair are
+        scheduled together (see calculate_energies). Every frame is recorded in the
+        manifest of its method in the event as soon as it is done, so when the task
+        is retried only the frames that are not done are computed again, and
+        appended to the results stream of the event (see progress.py). Failed frames
+        are retried until they are done or quarantined after frame_max_attempts
+        failed runs.
+
+        Parameters:
+
+        directory(str): directory of the trajectory
+        filename(str): name of the trajectory
+        energy_calculation_methods(list): names of the methods to run ORCA with
+        frames(list): frames to compute (0-based), None computes every frame
+        event_id(str): identifier of the webhook event, shared by the retries of its tasks
+        on_progress(callable): called with the (frame, method) pairs of the chunk done or
+                               quarantined, the pairs of the chunk and the EventProgress after every frame
+
+        Return:
+
+        dict: per method, the per-frame results from calculate_energies of the done
+              frames, the quarantined frames with their attempts and last error, and
+              the Redis key of the manifest
+    """
+    file_basename = splitext(basename(filename))[0]
+    chunk_name = 'all' if frames is None else f'{frames[0]}_{frames[-1]}' if frames else 'none'
+    print(f"\nProcessing file: {basename(filename)} with {', '.join(energy_calculation_methods)}, frames {chunk_name}")
     latest_file = os.path.join(directory, filename)
-    if latest_file:
-        print('found file ', latest_file)
-        separate_trajectory(latest_file, geo_path, 'geometry')
-        calculate_energy(geo_path, energy_path, filename, energy_calculation_method)
-        prepend_data(filename, "energy",energy_calculation_method)
-        prepend_data(filename, "gs_energy",energy_calculation_method)
-        remove_extension()
-        shutil.rmtree(geo_path)
-        shutil.rmtree(energy_path)
-        push_data_to_repo(directory,filename,energy_calculation_method, branch_name)
-
-    else:
-        print('No file found')
-
-def handle_push_events(directory, files, energy_calculation_method, branch_name):
-    """ """
-    if len(files) == 0:
-        print('No files to process')
-        return
-    num_processes = mp.cpu_count() - 1
-    pool = mp.Pool(processes=num_processes)
-    results = [pool.apply(process_file, args=(directory, filename,energy_calculation_method, branch_name)) for filename in files]
-    pool.close()
-    pool.join()
-    print(f'\nAll files processed')
-
-
-def handle_webhook_event(repo_name, branch_name, list_dvc_file_names):
-        directory = f"/home/vsaintloui/valmy/workrepo/{repo_name}"
-        files_to_process = get_last_dvc_pulled_files(directory, branch_name, list_dvc_file_names)
+    print('found file ', latest_file)
+    if frames is None:
+        frames = list(range(count_frames(latest_file)))
+
+    progress = EventProgress(REDIS_CLIENT, event_id) if event_id else None
+    event_key = event_id or uuid.uuid4().hex
+    manifests = {}
+    entries = {}
+    finished = {'frames': 0}
+    for energy_calculation_method in energy_calculation_methods:
+        # A changed template must not reuse the frames computed with the former one
+        with open(os.path.join(template_path, energy_calculation_method)) as orca_template:
+            template_digest = template_hash(orca_template.read())[:12]
+        key = manifest_key(event_key, basename(filename), f'{energy_calculation_method}@{template_digest}')
+        manifests[energy_calculation_method] = FrameManifest(REDIS_CLIENT, key, frame_max_attempts, manifest_ttl)
+        entries[energy_calculation_method] = manifests[energy_calculation_method].load()
+        method_entries = entries[energy_calculation_method]
+        resumed = [frame for frame in frames if method_entries.get(frame, {}).get('state') == DONE]
+        already_quarantined = [frame for frame in frames if method_entries.get(frame, {}).get('state') == QUARANTINED]
+        finished['frames'] += len(resumed) + len(already_quarantined)
+        if resumed or already_quarantined:
+            print(f'{len(resumed)} frames already done and {len(already_quarantined)} quarantined with '
+                  f'{energy_calculation_method} by a previous attempt')
+            metrics.increment('frames_resumed', len(resumed))
+            if progress is not None:
+                report_safely('report the resumed frames', progress.resumed, basename(filename),
+                              energy_calculation_method, resumed, already_quarantined)
+
+    # Every frame is checkpointed and streamed as soon as its result is known
+    total = len(frames) * len(energy_calculation_methods)
+    finished_lock = threading.Lock()
+
+    def on_record(energy_calculation_method, record):
+        frame = record['frame']
+        method_entries = entries[energy_calculation_method]
+        if record.get('complete', True):
+            manifests[energy_calculation_method].done(frame, record)
+            method_entries[frame] = {'state': DONE, 'record': record}
+            if progress is not None:
+                report_safely(f'stream frame {frame}', progress.frame_done, basename(filename),
+                              energy_calculation_method, record)
+        else:
+            method_entries[frame] = manifests[energy_calculation_method].failed(frame, record.get('error'), method_entries.get(frame))
+            if method_entries[frame]['state'] == QUARANTINED:
+                print(f"Quarantined frame {frame} of {basename(filename)} with {energy_calculation_method} "
+                      f"after {method_entries[frame]['attempts']} attempts: {method_entries[frame]['error']}")
+                metrics.increment('frames_quarantined')
+                if progress is not None:
+                    report_safely(f'stream quarantined frame {frame}', progress.frame_quarantined, basename(filename),
+                                  energy_calculation_method, frame, method_entries[frame]['error'])
+            else:
+                metrics.increment('frames_retried')
+        if method_entries[frame]['state'] in (DONE, QUARANTINED):
+            with finished_lock:
+                finished['frames'] += 1
+        if on_progress is not None:
+            report_safely('report the progress', on_progress, finished['frames'], total, progress)
+
+    # Everything the job writes stays in its own workspace, removed once the job is done
+    root = scratch_root(scratch_path, use_tmpfs_scratch)
+    scope = energy_calculation_methods[0] if len(energy_calculation_methods) == 1 else f'{len(energy_calculation_methods)}_methods'
+    while True:
+        remaining = {energy_calculation_method: [frame for frame in frames
+                                                 if entries[energy_calculation_method].get(frame, {}).get('state') not in (DONE, QUARANTINED)]
+                     for energy_calculation_method in energy_calculation_methods}
+        remaining = {energy_calculation_method: method_frames for energy_calculation_method, method_frames in remaining.items() if method_frames}
+        if not remaining:
+            break
+        seen = set()
+        with JobWorkspace(root, file_basename, scope, chunk_name) as workspace:
+            # The frames are separated once for every method still missing them
+            with metrics.stage('separate_trajectory'):
+                separate_trajectory(latest_file, workspace.geometries, 'geometry',
+                                    frames=sorted(set().union(*remaining.values())))
+            with metrics.stage('calculate_energy'):
+                results = calculate_energies(workspace.geometries, workspace.orca, filename, list(remaining),
+                                             {energy_calculation_method: set(method_frames)
+                                              for energy_calculation_method, method_frames in remaining.items()},
+                                             on_record)
+            for energy_calculation_method, method_records in results.items():
+                seen.update((energy_calculation_method, record['frame']) for record in method_records)
+        # A frame without any result (no log at all) counts as a failed attempt as well
+        for energy_calculation_method, method_frames in remaining.items():
+            for frame in method_frames:
+                if (energy_calculation_method, frame) not in seen:
+                    on_record(energy_calculation_method, {'frame': frame, 'complete': False, 'error': 'no result'})
+
+    results = {}
+    for energy_calculation_method in energy_calculation_methods:
+        method_entries = entries[energy_calculation_method]
+        records = [method_entries[frame]['record'] for frame in frames if method_entries[frame]['state'] == DONE]
+        quarantined = [{'frame': frame, 'attempts': method_entries[frame]['attempts'], 'error': method_entries[frame]['error']}
+                       for frame in frames if method_entries[frame]['state'] == QUARANTINED]
+        results[energy_calculation_method] = (records, quarantined, manifests[energy_calculation_method].key)
+    return results
+
+
+# Function running the compute subtasks, reporting their progress and catching their errors
+def compute_pieces(task, directory, filename, energy_calculation_methods, frames=None, event_id=None):
+    """ Function to compute one (trajectory, frame chunk) piece of a webhook event
+        with some methods (see process_trajectory) for a bound compute task
+
+        A failure retries the task up to compute_max_retries times, resuming from
+        the manifests of the event; only the last one is returned as an error.
+
+        The state of the task shows its chunk, the state of run_script, root of the
+        event, the whole event, at most every progress_interval seconds.
+
+        Return:
+
+        list: one result per method with filename, method, records, quarantined,
+              manifest and error, the first one with the metrics of the task
+    """
+    results = {energy_calculation_method: {'filename': filename, 'method': energy_calculation_method, 'records': [],
+                                           'quarantined': [], 'manifest': None, 'error': None}
+               for energy_calculation_method in energy_calculation_methods}
+    last_update = {'time': 0.0}
+
+    def report_progress(done, total, progress):
+        now = time.monotonic()
+        if task.request.id is None or (now - last_update['time'] < progress_interval and done < total):
+            return
+        last_update['time'] = now
+        event = progress.snapshot() if progress is not None else None
+        task.update_state(state='PROGRESS', meta={'file': basename(filename), 'methods': energy_calculation_methods,
+                                                   'done': done, 'total': total, 'event': event})
+        if event is not None and task.request.root_id not in (None, task.request.id):
+            app.backend.store_result(task.request.root_id, event, 'PROGRESS')
+
+    try:
+        computed = process_trajectory(directory, filename, energy_calculation_methods, frames, event_id, report_progress)
+        for energy_calculation_method, (records, quarantined, manifest) in computed.items():
+            results[energy_calculation_method].update(records=records, quarantined=quarantined, manifest=manifest)
+    except Exception as e:
+        print(f'Exception occurred: {e}')
+        capture_exception(e)
+        # The frames done so far are in the manifests, the retry only computes the others
+        if task.request.retries < compute_max_retries:
+            raise task.retry(exc=e, countdown=compute_retry_delay * 2 ** task.request.retries)
+        for result in results.values():
+            result['error'] = str(e)
+    # The metrics of the task go with one of its results only, so aggregate_event counts them once
+    results = list(results.values())
+    if results:
+        results[0]['metrics'] = metrics.current.to_dict()
+    return results
+
+
+@app.task(bind=True, max_retries=compute_max_retries)
+# Function computing one (trajectory, method, frame chunk) piece of a webhook event
+def process_file_task(self, directory, filename, energy_calculation_method, frames=None, event_id=None):
+    return compute_pieces(self, directory, filename, [energy_calculation_method], frames, event_id)[0]
+
+
+@app.task(bind=True, max_retries=compute_max_retries)
+# Function computing one (trajectory, frame chunk) piece of a webhook event with every method
+def process_trajectory_task(self, directory, filename, energy_calculation_methods, frames=None, event_id=None):
+    return compute_pieces(self, directory, filename, energy_calculation_methods, frames, event_id)
+
+
+@app.task
+# Function preparing one trajectory of a webhook event: its frame index and the selection of its frames
+def split_trajectory_task(directory, filename, frame_selection=None, num_methods=1):
+    """ Function to index the frames of a trajectory and select the ones to compute
+
+        Opening the trajectory builds its frame index once, cached next to it, so the
+        compute tasks reuse it.
+
+        Parameters:
+
+        directory(str): directory of the trajectory
+        filename(str): name of the trajectory
+        frame_selection(dict): selection of the frames (see frame_selection.select_frames), None computes every frame
+        num_methods(int): methods a compute subtask runs on every frame of its chunk
+
+        Return:
+
+        dict: filename, selection record (None without frame_selection), frame chunks
+              of the compute subtasks, number of frames to compute, error and metrics
+    """
+    result = {'filename': filename, 'selection': None, 'chunks': [], 'num_frames': 0, 'error': None}
+    file_path = os.path.join(directory, filename)
+    try:
+        with metrics.stage('frame_index'):
+            for trajectory_file in find_trajectory_files(file_path):
+                with XYZTrajectory(trajectory_file):
+                    pass
+        frames = None
+        if frame_selection:
+            with metrics.stage('frame_selection'):
+                frames, total_frames = select_frames(file_path, frame_selection)
+            result['selection'] = {'selection': frame_selection, 'total_frames': total_frames, 'frames': frames}
+            print(f'Selected {len(frames)} of {total_frames} frames of {basename(filename)}')
+        result['chunks'] = frame_chunks(file_path, frames, num_methods)
+        result['num_frames'] = len(frames) if frames is not None else count_frames(file_path)
+    except Exception as e:
+        print(f'Exception occurred: {e}')
+        capture_exception(e)
+        result['error'] = str(e)
+    result['metrics'] = metrics.current.to_dict()
+    return result
+
+
+def handle_push_events(directory, splits, energy_calculation_methods, event_id=None):
+    """ Function to build one Celery subtask per trajectory computing every method
+        with multi_method_tasks, otherwise one per (trajectory, method) pair, each
+        split further by frame chunk (see frame_chunks)
+
+        Parameters:
+
+        directory(str): directory of the trajectories
+        splits(list): results of split_trajectory_task for the trajectories to process
+        energy_calculation_methods(list): methods to run on every trajectory
+        event_id(str): identifier of the event, naming the manifests of its frames
+
+        Return:
+
+        celery.group: the subtasks, to be run in parallel on every worker of the compute queue
+    """
+    if multi_method_tasks:
+        return group(
+            process_trajectory_task.s(directory, split['filename'], energy_calculation_methods, frames, event_id)
+            for split in splits
+            for frames in split['chunks']
+        )
+    return group(
+        process_file_task.s(directory, split['filename'], energy_calculation_method, frames, event_id)
+        for split in splits
+        for frames in split['chunks']
+        for energy_calculation_method in energy_calculation_methods
+    )
+
+
+@app.task
+# Chord callback fanning out the ORCA runs of an event once all its trajectories are split
+def dispatch_event(splits, repo_name, directory, branch_name, list_dvc_file_names, start_time, energy_calculation_methods, event_metrics=None, event_id=None, trajectory_directory=None):
+    dispatch_metrics = Metrics()
+    dispatch_metrics.merge(event_metrics or {})
+    for split in splits:
+        dispatch_metrics.merge(split.get('metrics') or {})
+        if split['error'] is not None:
+            print(f"Skipping {basename(split['filename'])}: {split['error']}")
+    splits = [split for split in splits if split['error'] is None]
+    selections = {split['filename']: split['selection'] for split in splits if split['selection'] is not None}
+    if event_id is not None:
+        total_frames = sum(split['num_frames'] for split in splits) * len(energy_calculation_methods)
+        report_safely('start the progress of the event', EventProgress(REDIS_CLIENT, event_id).start,
+                      repo_name, branch_name, total_frames)
+
+    callback = (aggregate_event.s(repo_name, branch_name, list_dvc_file_names, start_time, selections,
+                                  dispatch_metrics.to_dict(), event_id) |
+                publish_event.s(repo_name, directory, branch_name, list_dvc_file_names, start_time, trajectory_directory))
+    chord(handle_push_events(trajectory_directory or directory, splits, energy_calculation_methods, event_id))(callback)
+
+
+@app.task
+# Chord callback merging the results of every piece of an event into property stores staged for publish_event
+def aggregate_event(results, repo_name, branch_name, list_dvc_file_names, start_time, selections=None, event_metrics=None, event_id=None):
+    """ Function to write the outputs of an event to a staging directory of its own
+
+        Nothing touches the working tree of the repository here, so events of the
+        same repository aggregate in parallel. publish_event moves the outputs into
+        the working tree under the repository lock.
+
+        Return:
+
+        dict: staging directory, paths of the outputs relative to it, Redis keys of
+              the manifests of the event and its identifier
+    """
+    # Metrics of the whole event: the fetch, the split, every subtask and this callback
+    aggregated_metrics = Metrics()
+    aggregated_metrics.merge(event_metrics or {})
+    merged = {}
+    failed = set()
+    quarantined = []
+    manifests = set()
+    # A multi-method subtask returns the results of every method it computed
+    results = [entry for result in results for entry in (result if isinstance(result, list) else [result])]
+    for result in results:
+        key = (result['filename'], result['method'])
+        merged.setdefault(key, []).extend(result['records'])
+        aggregated_metrics.merge(result.get('metrics') or {})
+        if result['error'] is not None:
+            failed.add(key)
+        if result.get('manifest'):
+            manifests.add(result['manifest'])
+        quarantined += [dict(entry, file=basename(result['filename']), method=result['method'])
+                        for entry in result.get('quarantined') or []]
+    # Quarantined frames have no line in the outputs, the report lists them
+    if quarantined:
+        sentry_sdk.capture_message(f'{len(quarantined)} frames quarantined in {repo_name}/{branch_name}')
+
+    os.makedirs(staging_path, exist_ok=True)
+    staging_directory = tempfile.mkdtemp(prefix=f'{repo_name}_{branch_name}_{int(start_time)}_', dir=staging_path)
+    output_files = []
+    for (filename, energy_calculation_method), records in merged.items():
+        if (filename, energy_calculation_method) in failed:
+            print(f'Skipping {basename(filename)} with {energy_calculation_method}: a subtask failed')
+            continue
+        try:
+            with metrics.stage('write_results'):
+                output_files += write_energy_data(staging_directory, filename, energy_calculation_method, records)
+        except Exception as e:
+            print(f'Exception occurred: {e}')
+            capture_exception(e)
+
+    # Record which frames were computed, so the dataset stays traceable to the trajectory
+    for filename, selection in (selections or {}).items():
+        selection_file = f"{staging_directory}/{splitext(basename(filename))[0]}/frame_selection.json"
+        os.makedirs(os.path.dirname(selection_file), exist_ok=True)
+        with open(selection_file, 'w') as f:
+            json.dump(selection, f)
+        output_files.append(selection_file)
+
+    # The report is committed with the data, so it covers everything up to the publish step
+    aggregated_metrics.merge(metrics.current.to_dict())
+    report_file = f"{staging_directory}/reports/{repo_name}_{branch_name}_{int(start_time)}.json"
+    output_files.append(write_event_report(report_file, {
+        'repository': repo_name,
+        'branch': branch_name,
+        'files': list_dvc_file_names,
+        'started': start_time,
+        'seconds_before_publish': time.time() - start_time,
+        'failed': [[basename(filename), method] for filename, method in sorted(failed)],
+        'quarantined': sorted(quarantined, key=lambda entry: (entry['file'], entry['method'], entry['frame'])),
+        'metrics': aggregated_metrics.to_dict(),
+    }))
+    return {'staging': staging_directory, 'outputs': [os.path.relpath(path, staging_directory) for path in output_files],
+            'manifests': sorted(manifests), 'event_id': event_id}
+
+
+# Function to move a staged output into the working tree, replacing the previous version
+def replace_path(source, destination):
+    if os.path.isdir(destination) and not os.path.islink(destination):
+        shutil.rmtree(destination)
+    elif os.path.lexists(destination):
+        os.remove(destination)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.move(source, destination)
+
+
+@app.task(bind=True, max_retries=lock_max_requeues)
+# Function publishing the staged outputs of an event
+def publish_event(self, staged, repo_name, directory, branch_name, list_dvc_file_names, start_time, trajectory_directory=None):
+    # The clone is shared by every branch of the repository: the branch is checked out, the outputs moved in,
+    # published and cleaned up under one lock, so no other event switches the branch or deletes them meanwhile
+    repository_lock = acquire_lock(self, repository_lock_name(repo_name))
+    clone_directory, _, output_directory = repository_paths(repo_name)
+    published = False
+    try:
+        with metrics.stage('git_fetch'):
+            checkout_commit(clone_directory, branch_name)
+        repository_lock.check()
+        output_files = []
+        with metrics.stage('move_results'):
+            for relative_path in staged['outputs']:
+                replace_path(os.path.join(staged['staging'], relative_path), os.path.join(output_directory, relative_path))
+                output_files.append(os.path.join(output_directory, relative_path))
+
+        # One dvc add, one commit and one push for the whole event
+        try:
+            publish_report = publish_outputs(clone_directory, output_files, branch_name, lock=repository_lock)
+            for stage_name in ('dvc_add', 'git_commit', 'git_push'):
+                metrics.observe(stage_name, publish_report[stage_name])
+            metrics.increment('push_attempts', publish_report['push_attempts'])
+            published = True
+        except Exception as e:
+            print(f'Exception occurred: {e}')
+            capture_exception(e)
+        print(f'\nAll files processed')
+
+        # Computed results are only thrown away once they are published, and not from a tree another event may hold
+        if published and not repository_lock.lost:
+            with metrics.stage('cleanup'):
+                basenames = [os.path.splitext(os.path.splitext(name)[0])[0] for name in list_dvc_file_names] 
+                delete_contents_geometries(directory, ['xyz', 'dvc'], basenames)
+                delete_published_outputs(output_files)
+                if staged.get('manifests'):
+                    REDIS_CLIENT.delete(*staged['manifests'])
+        else:
+            print(f'Publishing failed, the outputs stay in {output_directory} and the frames in the manifests of the event')
+    finally:
+        repository_lock.release()
+
+    if staged.get('event_id'):
+        progress = EventProgress(REDIS_CLIENT, staged['event_id'])
+        report_safely('finish the progress of the event', progress.finish, published=published)
+        if self.request.root_id not in (None, self.request.id):
+            snapshot = report_safely('read the progress of the event', progress.snapshot)
+            report_safely('store the state of the event', app.backend.store_result, self.request.root_id,
+                          dict(snapshot or {}, published=published), 'SUCCESS' if published else 'PUBLISH_FAILED')
+    shutil.rmtree(staged['staging'], ignore_errors=True)
+    # A new attempt at the event fetches and stages the trajectories again
+    if trajectory_directory:
+        shutil.rmtree(trajectory_directory, ignore_errors=True)
+    end_time = time.time()
+    metrics.observe('event', end_time - start_time)
+    print(f'Total time taken: {end_time - start_time} seconds')
+
+
+def handle_webhook_event(repo_name, branch_name, list_dvc_file_names, frame_selection=None, commit_sha=None):
+        """ Function to fetch the pushed trajectories and fan out their processing
+
+            Each stage of the event runs on the workers of its own queue (see
+            celery_app.py): every trajectory is indexed and its frames selected by a
+            split task, then every trajectory is computed with every method by a
+            compute subtask (one per (trajectory, method) pair without
+            multi_method_tasks), the results are merged by aggregate_event and
+            published by publish_event once all of them are done.
+
+            The frames sent to ORCA are subsampled with frame_selection when given,
+            otherwise with the selection configured for the repository in
+            frame_selection_config, if any (see frame_selection.select_frames).
+
+            commit_sha is the commit of the push, fetched alone into the clone kept
+            under workrepo_path. The pulled trajectories are linked into a staging
+            directory of the event (see stage_trajectories), read by its tasks.
+        """
+        directory, _, _ = repository_paths(repo_name)
+        with metrics.stage('fetch'):
+            files_to_process = get_last_dvc_pulled_files(directory, branch_name, list_dvc_file_names, commit_sha)
 
         if len(files_to_process) == 0:
             print('No files found')
-        else:
-            directory = os.path.dirname(files_to_process[0])
-            print(f'Number of files to process: {len(files_to_process)}\n')
-            start_time = time.time()
-
-            template_files = glob.glob('/home/vsaintloui/valmy/template/*')
-            for input_file_path in template_files:
-                input_file_basename = splitext(basename(input_file_path))[0]
-                try:
-                    print('Before handle_push_events')  
-                    handle_push_events(directory, files_to_process, input_file_basename,branch_name)
-                    print('After handle_push_events')  
-                except Exception as e:
-                    print(f'Exception occurred: {e}')
-                    capture_exception(e)
-
-            directory_to_delete = f"{output_repo}"
-            basenames = [os.path.splitext(os.path.splitext(name)[0])[0] for name in list_dvc_file_names] 
-            delete_local_files(directory, directory_to_delete, ['xyz', 'dvc'], basenames)
-            end_time = time.time()
-            print(f'Total time taken: {end_time - start_time} seconds')
+            return None
+
+        directory = os.path.dirname(files_to_process[0])
+        print(f'Number of files to process: {len(files_to_process)}\n')
+        start_time = time.time()
+        # Publishing another event of the repository deletes its trajectories from the clone, the tasks of
+        # this event read their own links
+        with metrics.stage('stage_trajectories'):
+            trajectory_directory, files_to_process = stage_trajectories(
+                files_to_process, directory, f'{repo_name}_{branch_name}_{int(start_time)}')
+
+        frame_selection = frame_selection or load_selection_config(frame_selection_config, repo_name)
+        template_files = glob.glob(os.path.join(template_path, '*'))
+        energy_calculation_methods = [splitext(basename(input_file_path))[0] for input_file_path in template_files]
+        # The frames of a push computed by an earlier attempt at its event are picked up from its manifests
+        event_id = f'{repo_name}:{branch_name}:{commit_sha or uuid.uuid4().hex}'
+        callback = dispatch_event.s(repo_name, directory, branch_name, list_dvc_file_names, start_time,
+                                    energy_calculation_methods, metrics.current.to_dict(), event_id,
+                                    trajectory_directory)
+        num_methods = len(energy_calculation_methods) if multi_method_tasks else 1
+        return chord(group(split_trajectory_task.s(trajectory_directory, filename, frame_selection, num_methods)
+                           for filename in files_to_process))(callback)
 
 
 REDIS_CLIENT = redis.Redis()
-@contextmanager
-def redis_lock(lock_name):
-    """ Jozo (2012). Celery task schedule: Ensuring a task is only executed one at a time. Retrieved from
-        https://stackoverflow.com/questions/12003221/celery-task-schedule-ensuring-a-task-is-only-executed-one-at-a-time.
-        
-        Yield 1 if specified lock_name is not already set in redis. Otherwise returns 0.
-        Enables sort of lock functionality.
-    
-        Parameters : 
-    
-        lock_name (str): name choosen for the lock in string 
-    
-    """
-    status = REDIS_CLIENT.set(lock_name, 'lock', nx=True)
+
+
+@task_prerun.connect
+# Function starting the metrics of a task and recording how long it waited in its queue
+def start_task_metrics(task=None, **kwargs):
+    # Eager tasks run inside the task calling them, its metrics are put back when they finish
+    metrics.push()
+    published_at = task.request.get('published_at') if task is not None else None
+    if published_at:
+        metrics.observe('queue_wait', max(time.time() - published_at, 0))
+
+
+@task_postrun.connect
+# Function adding the metrics of a finished task to the totals exported for Prometheus
+def export_task_metrics(**kwargs):
+    metrics.totals.merge(metrics.pop().to_dict())
     try:
-        yield status
-    finally:
-        REDIS_CLIENT.delete(lock_name)
+        write_prometheus_textfile(metrics_textfile_directory, metrics.totals)
+    except OSError as e:
+        print(f'Failed to write metrics to {metrics_textfile_directory}. Reason: {e}')
 
 
-@app.task(bind=True)
-# Function that call handle_webhook_event() function
-def run_script(self, repo_name, branch_name, list_dvc_file_names):
-        with redis_lock('lock_key_777') as acquired:
-            handle_webhook_event(repo_name, branch_name, list_dvc_file_names)
-            
+@worker_process_shutdown.connect
+# Function removing the metrics file of an exiting worker process, a new process exports under its own pid
+def remove_task_metrics(**kwargs):
+    try:
+        remove_prometheus_textfile(metrics_textfile_directory)
+    except OSError as e:
+        print(f'Failed to remove metrics from {metrics_textfile_directory}. Reason: {e}')
+
+
+# Function to take a lock for a task, applying the lock_contention_policy when it is taken
+def acquire_lock(task, lock_name):
+    """ Function to take a lock for a task
 
+        With the 'requeue' policy a contended lock sends the task back to its queue
+        for lock_requeue_delay seconds, with the 'wait' policy the task waits up to
+        lock_wait_timeout seconds for the lock.
 
-   
+        Parameters:
+
+        task(celery.Task): bound task asking for the lock
+        lock_name(str): key of the lock
+
+        Return:
+
+        DistributedLock: the held lock, to release once done
+    """
+    lock = DistributedLock(REDIS_CLIENT, lock_name, lock_ttl)
+    if lock_contention_policy == 'wait':
+        if not lock.acquire(blocking=True, timeout=lock_wait_timeout):
+            raise LockContended(f'Could not acquire {lock_name} within {lock_wait_timeout} seconds')
+    elif not lock.acquire(blocking=False):
+        print(f'{lock_name} is taken, requeueing in {lock_requeue_delay} seconds')
+        raise task.retry(countdown=lock_requeue_delay)
+    return lock
+
+
+@app.task(bind=True, max_retries=lock_max_requeues)
+# Function that call handle_webhook_event() function
+def run_script(self, repo_name, branch_name, list_dvc_file_names, frame_selection=None, commit_sha=None):
+        # Events of the same repository wait for each other, their branches share the clone
+        lock = acquire_lock(self, repository_lock_name(repo_name))
+        try:
+            handle_webhook_event(repo_name, branch_name, list_dvc_file_names, frame_selection, commit_sha)
+        finally:
+            lock.release()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import os
+import mmap
+import struct
+from array import array
+from pathlib import Path
+
+
+# Suffix of the frame index cached next to each trajectory. The index is saved as
+# '<name>.xyz.idx' so delete_contents_geometries() removes it together with the trajectory.
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'XYZIDX1\0'
+INDEX_HEADER = struct.Struct('<8sQQ')
+
+
+# Function to list the trajectory files behind a path
+def find_trajectory_files(path):
+    """ Function to list every .xyz trajectory behind a path
+
+        Parameters:
+
+        path(str): path of a trajectory file or of a directory containing trajectories
+
+        Return:
+
+        list: sorted paths of the .xyz files, a file path is returned as is
+    """
+    if os.path.isfile(path):
+        return [path]
+    return sorted(file.as_posix() for file in Path(path).rglob('*.xyz'))
+
+
+# Function to scan a trajectory and record where every frame starts
+def build_frame_index(mm):
+    """ Function to scan a memory-mapped trajectory once and record the byte offset
+        of every frame. A frame is a line holding the number of atoms, a comment line
+        and one line per atom.
+
+        Parameters:
+
+        mm(mmap.mmap): memory-mapped trajectory
+
+        Return:
+
+        array: offsets of each frame start followed by the end offset of the last frame
+    """
+    offsets = array('Q')
+    size = len(mm)
+    position = 0
+    while position < size:
+        end = mm.find(b'\n', position)
+        if end == -1:
+            end = size
+        header = mm[position:end].strip()
+        if not header:
+            position = end + 1
+            continue
+        if not header.isdigit():
+            raise ValueError(f'Expected an atom count at byte {position}, found {header[:40]!r}')
+
+        offsets.append(position)
+        # Skip the comment line and one line per atom
+        for _ in range(int(header) + 1):
+            end = mm.find(b'\n', end + 1)
+            if end == -1:
+                end = size
+                break
+        position = end + 1
+    offsets.append(min(position, size))
+    return offsets
+
+
+def _read_cached_index(index_path, stat):
+    try:
+        with open(index_path, 'rb') as f:
+            magic, size, mtime_ns = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+            if magic != INDEX_MAGIC or size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+                return None
+            offsets = array('Q')
+            offsets.frombytes(f.read())
+            return offsets
+    except (OSError, struct.error, ValueError):
+        return None
+
+
+def _write_cached_index(index_path, stat, offsets):
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns))
+            f.write(offsets.tobytes())
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        # The index is only a cache, a read-only directory must not stop the pipeline
+        print(f'Could not cache frame index {index_path}. Reason: {e}')
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class XYZTrajectory:
+    """ Random access to the frames of a multi-frame .xyz trajectory
+
+        The file is memory-mapped and a byte-offset index of the frame boundaries is
+        built once and cached next to the trajectory as '<name>.xyz.idx', so asking
+        for frame N or a range of frames never reads the other frames.
+
+        Parameters:
+
+        path(str): path of the trajectory file
+        index_path(str): where to cache the frame index, defaults to next to the trajectory
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + INDEX_SUFFIX
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        if stat.st_size == 0:
+            self._mm = None
+            self.offsets = array('Q', [0])
+            return
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = _read_cached_index(self.index_path, stat)
+        if self.offsets is None:
+            self.offsets = build_frame_index(self._mm)
+            _write_cached_index(self.index_path, stat, self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+    def frame_bytes(self, n):
+        """ Return the raw bytes of frame n (0-based) """
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError(f'Frame {n} out of range for {self.path} ({len(self)} frames)')
+        return self._mm[self.offsets[n]:self.offsets[n + 1]]
+
+    def frame(self, n):
+        """ Return frame n (0-based) as a string ending with a newline """
+        text = self.frame_bytes(n).decode('utf-8').rstrip('\n')
+        return text + '\n'
+
+    def frames(self, start=0, stop=None, step=1):
+        """ Yield (frame number, frame string) for a range of frames """
+        for n in range(*slice(start, stop, step).indices(len(self))):
+            yield n, self.frame(n)
+
+    def comment(self, n):
+        """ Return the comment (second) line of frame n without reading its atoms """
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError(f'Frame {n} out of range for {self.path} ({len(self)} frames)')
+        start = self._mm.find(b'\n', self.offsets[n], self.offsets[n + 1]) + 1
+        end = self._mm.find(b'\n', start, self.offsets[n + 1])
+        return self._mm[start:end if end >= 0 else self.offsets[n + 1]].decode('utf-8').rstrip('\r')
+
+    def atom_count(self, n):
+        """ Return the number of atoms declared in the header line of frame n """
+        return int(self.frame_bytes(n).split(b'\n', 1)[0])
+
+
+# Function to count the frames of a trajectory, or of every trajectory of a directory
+def count_frames(path):
+    """ Return the number of frames behind a path (see find_trajectory_files), read
+        from the frame index of every trajectory """
+    num_frames = 0
+    for trajectory_file in find_trajectory_files(path):
+        with XYZTrajectory(trajectory_file) as trajectory:
+            num_frames += len(trajectory)
+    return num_frames
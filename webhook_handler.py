@@ -1,27 +1,27 @@
 #!/usr/bin/env python3
 
-from script import run_script
 from celery_app import app
+from webhook_receiver import dvc_files_from_payload
 import sys
-import os
 import json
 
 # Main function that takes 3 arguments from the webhook and sends the result to the Celery task run_script
 if __name__ == "__main__":
     """ Main function that takes 3 arguments from the whole payload 
         and sends the result to the celery task which is run_script
+
+        Kept for the webhook daemon configured in hooks.json, webhook_receiver.py
+        replaces it with a long-running receiver that coalesces pushes.
     
     """
     payload = json.loads(sys.argv[1])
     repo_name = payload['repository']['name']
     branch_name = payload['ref'].split('/')[-1]
     
-    list_dvc_file_paths = []
-    for commit in payload['commits']:
-         if commit['added'] is not None:
-            list_dvc_file_paths.extend(commit['added'])
-    list_dvc_file_names = [os.path.basename(file) for file in list_dvc_file_paths if file.endswith('.xyz.dvc')]
+    list_dvc_file_names = dvc_files_from_payload(payload)
 
-    result = run_script.apply_async(args=(repo_name, branch_name, list_dvc_file_names), queue='script')
+    # Sent by name so this script never imports the worker module, celery_app routes it to the fetch queue
+    result = app.send_task('script.run_script', args=(repo_name, branch_name, list_dvc_file_names),
+                           kwargs={'commit_sha': payload.get('after')})
     print("Task submitted:", result.id)
-    print(list_dvc_file_names)
\ No newline at end of file
+    print(list_dvc_file_names)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import os
+import hmac
+import json
+import time
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import sentry_sdk
+from sentry_sdk import capture_exception
+
+from celery_app import app
+
+
+# Function to list the trajectories added by a push
+def dvc_files_from_payload(payload):
+    """ Function to list the names of the .xyz.dvc files added by the commits of a push
+
+        Parameters:
+
+        payload(dict): Gitea push payload
+
+        Return:
+
+        list: base names of the added .xyz.dvc files, in the order they were pushed
+    """
+    list_dvc_file_paths = []
+    for commit in payload.get('commits') or []:
+        if commit.get('added') is not None:
+            list_dvc_file_paths.extend(commit['added'])
+    return [os.path.basename(file) for file in list_dvc_file_paths if file.endswith('.xyz.dvc')]
+
+
+# Function to check the signature Gitea computes over the request body
+def verify_signature(secret, body, signature):
+    expected = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return signature is not None and hmac.compare_digest(expected, signature.strip())
+
+
+class PushCoalescer:
+    """ Debounces pushes to the same repository and branch into a single task
+
+        A push (re)starts a timer of window seconds for its repository and branch.
+        When the timer fires, one run_script task is sent with the union of the
+        .xyz.dvc files of every push received meanwhile and the commit of the last
+        one. A burst never delays a task by more than max_delay seconds after its
+        first push. When the task cannot be sent (broker down) the pushes are kept
+        and sent again after retry_delay seconds, doubled at every failure up to
+        max_retry_delay, together with the pushes received meanwhile.
+
+        Parameters:
+
+        window(float): quiet time in seconds before the pending pushes are sent
+        max_delay(float): longest time in seconds a push may wait
+        queue(str): Celery queue the task is sent to, the route of run_script in celery_app.py when None
+        priority(int): priority of the events, from 0 (first) to 9 (last), inherited by all their subtasks
+        retry_delay(float): seconds before a task that could not be sent is sent again
+        max_retry_delay(float): longest time in seconds between two attempts
+    """
+
+    def __init__(self, window=30.0, max_delay=300.0, queue=None, priority=None, retry_delay=10.0, max_retry_delay=300.0):
+        self.window = window
+        self.max_delay = max_delay
+        self.queue = queue
+        self.priority = priority
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, repo_name, branch_name, list_dvc_file_names, commit_sha=None):
+        key = (repo_name, branch_name)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = {'files': [], 'first_push': time.monotonic(), 'timer': None}
+            else:
+                pending['timer'].cancel()
+            # The last push of a branch contains the commits of the earlier ones
+            pending['commit_sha'] = commit_sha
+            pending['files'].extend(name for name in list_dvc_file_names if name not in pending['files'])
+            delay = min(self.window, max(pending['first_push'] + self.max_delay - time.monotonic(), 0))
+            pending['timer'] = threading.Timer(delay, self.flush, args=key)
+            pending['timer'].daemon = True
+            pending['timer'].start()
+
+    def flush(self, repo_name, branch_name):
+        key = (repo_name, branch_name)
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        # Runs in a timer thread after the sender got its 202, a failure must not lose the pushes
+        try:
+            # Sent by name so the receiver never imports the worker module
+            result = app.send_task('script.run_script', args=(repo_name, branch_name, pending['files']),
+                                   kwargs={'commit_sha': pending['commit_sha']}, queue=self.queue, priority=self.priority)
+        except Exception as e:
+            pending['attempts'] = pending.get('attempts', 0) + 1
+            delay = min(self.retry_delay * 2 ** (pending['attempts'] - 1), self.max_retry_delay)
+            print(f"Failed to submit the task for {repo_name}/{branch_name} (attempt {pending['attempts']}), "
+                  f"retrying in {delay:.0f} seconds. Reason: {e}")
+            capture_exception(e)
+            self._retry(key, pending, delay)
+            return
+        print(f"Task submitted: {result.id} for {repo_name}/{branch_name}: {pending['files']}")
+
+    def _retry(self, key, pending, delay):
+        with self._lock:
+            # Pushes received while sending are merged in, the last one holds the commit
+            newer = self._pending.get(key)
+            if newer is not None:
+                newer['timer'].cancel()
+                pending['files'].extend(name for name in newer['files'] if name not in pending['files'])
+                pending['commit_sha'] = newer['commit_sha']
+            self._pending[key] = pending
+            pending['timer'] = threading.Timer(delay, self.flush, args=key)
+            pending['timer'].daemon = True
+            pending['timer'].start()
+
+    def flush_all(self):
+        with self._lock:
+            keys = list(self._pending)
+            for key in keys:
+                self._pending[key]['timer'].cancel()
+        for key in keys:
+            self.flush(*key)
+        # Whatever still failed is lost with the process, at least it is reported
+        with self._lock:
+            for (repo_name, branch_name), pending in self._pending.items():
+                pending['timer'].cancel()
+                print(f"Pushes of {repo_name}/{branch_name} not submitted: {pending['files']} at {pending['commit_sha']}")
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """ Receives the Gitea push webhooks and hands them to the coalescer """
+
+    server_version = 'TrajectoryWebhook/1.0'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        settings = self.server.settings
+
+        if not verify_signature(settings.secret, body, self.headers.get('X-Gitea-Signature')):
+            return self._reply(403, 'Invalid signature')
+        try:
+            payload = json.loads(body)
+            repo_name = payload['repository']['name']
+            branch_name = payload['ref'].split('/')[-1]
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return self._reply(400, f'Invalid payload: {e}')
+
+        # Pushes made by the pipeline itself must not trigger it again
+        author = ((payload.get('head_commit') or {}).get('author') or {}).get('name')
+        if author in settings.ignored_authors:
+            return self._reply(200, f'Ignored push from {author}')
+
+        list_dvc_file_names = dvc_files_from_payload(payload)
+        if not list_dvc_file_names:
+            return self._reply(200, 'No .xyz.dvc file added')
+
+        self.server.coalescer.add(repo_name, branch_name, list_dvc_file_names, payload.get('after'))
+        return self._reply(202, f'Queued {list_dvc_file_names}')
+
+    def _reply(self, status, message):
+        body = message.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Main function that serves the webhook until interrupted
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Receive Gitea push webhooks and enqueue the trajectory pipeline')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--secret', default=os.environ.get('WEBHOOK_SECRET', 'secret'),
+                        help='HMAC secret of the Gitea webhook, defaults to $WEBHOOK_SECRET')
+    parser.add_argument('--ignore-author', dest='ignored_authors', action='append', default=None,
+                        help='author whose pushes are ignored, can be repeated (default: vsaintlouis)')
+    parser.add_argument('--window', type=float, default=30.0,
+                        help='seconds without a push before the pushes of a repository/branch are sent as one task')
+    parser.add_argument('--max-delay', type=float, default=300.0,
+                        help='longest time in seconds a push may be held back by the window')
+    parser.add_argument('--queue', default=None, help='queue of the run_script tasks (default: the fetch queue)')
+    parser.add_argument('--priority', type=int, choices=range(10), default=None,
+                        help='priority of the events, 0 (first) to 9 (last)')
+    parser.add_argument('--retry-delay', type=float, default=10.0,
+                        help='seconds before a task the broker did not accept is sent again, doubled at every failure')
+    parser.add_argument('--sentry-dsn', default=os.environ.get('SENTRY_DSN'),
+                        help='Sentry DSN the failures are reported to, defaults to $SENTRY_DSN')
+    settings = parser.parse_args()
+    sentry_sdk.init(settings.sentry_dsn)
+    settings.ignored_authors = set(settings.ignored_authors or ['vsaintlouis'])
+
+    server = ThreadingHTTPServer((settings.host, settings.port), WebhookHandler)
+    server.settings = settings
+    server.coalescer = PushCoalescer(settings.window, settings.max_delay, settings.queue, settings.priority,
+                                     settings.retry_delay)
+    print(f'Listening on {settings.host}:{settings.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.coalescer.flush_all()
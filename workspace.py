@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import os
+import uuid
+import shutil
+
+
+# Function to choose where the job workspaces are created
+def scratch_root(scratch_path, use_tmpfs=False, tmpfs_path='/dev/shm', tmpfs_min_free=2 * 1024 ** 3):
+    """ Function to choose the root of the job workspaces
+
+        Parameters:
+
+        scratch_path(str): directory on disk used by default
+        use_tmpfs(bool): prefer the memory-backed tmpfs_path when it exists
+        tmpfs_path(str): mount point of the tmpfs
+        tmpfs_min_free(int): bytes that must be free on the tmpfs to use it
+
+        Return:
+
+        str: path of the root directory
+    """
+    if use_tmpfs and os.path.isdir(tmpfs_path):
+        stat = os.statvfs(tmpfs_path)
+        if stat.f_bavail * stat.f_frsize >= tmpfs_min_free:
+            return os.path.join(tmpfs_path, 'trajectory-pipeline')
+        print(f'Less than {tmpfs_min_free} bytes free on {tmpfs_path}, using {scratch_path}')
+    return scratch_path
+
+
+class JobWorkspace:
+    """ Scratch directory owned by a single job
+
+        Every job gets a directory of its own under root, named after its scope and
+        made unique by a random suffix, with a 'geometries' directory for the
+        separated frames and an 'orca' directory for the ORCA inputs, logs and
+        temporary files. The whole directory is removed when the job is done, so
+        two jobs on the same node never see each other's files.
+
+        Parameters:
+
+        root(str): directory the workspaces are created in
+        scope(str): names describing the job, e.g. trajectory, method and frame range
+        keep(bool): leave the directory in place on exit, for debugging
+    """
+
+    def __init__(self, root, *scope, keep=False):
+        name = '_'.join(str(part) for part in scope) or 'job'
+        self.path = os.path.join(root, f'{name}_{uuid.uuid4().hex[:12]}')
+        self.geometries = os.path.join(self.path, 'geometries')
+        self.orca = os.path.join(self.path, 'orca')
+        self.keep = keep
+
+    def __enter__(self):
+        os.makedirs(self.geometries)
+        os.makedirs(self.orca)
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+    def cleanup(self):
+        if not self.keep:
+            shutil.rmtree(self.path, ignore_errors=True)